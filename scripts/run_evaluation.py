@@ -33,6 +33,12 @@ def make_cli_parser() -> argparse.ArgumentParser:
         type=Path,
         default=Path("./data/evaluation/runs/"),
     )
+    parser.add_argument(
+        "--dataset-snapshot",
+        help="snapshot file of the built dataset, loaded if it exists, created otherwise",
+        type=Path,
+        default=None,
+    )
     parser.add_argument(
         "--device",
         help="device to use to run the evaluation pipeline.",
@@ -80,12 +86,27 @@ if __name__ == "__main__":
             f"Evaluation of the models located in {dir_models} on the dataset {dir_dataset} running on device {device}"
         )
 
-        # Instanciate Dataset
-        dataset = EvaluationDataset(
-            datapath=dir_dataset,
-            dataset_ID=dir_dataset.stem,
-        )
-        dataset.dump()
+        # Instanciate Dataset, from its snapshot when it matches the dataset files
+        dataset_snapshot = args["dataset_snapshot"]
+        snapshot_mismatch = "no snapshot"
+        if dataset_snapshot and dataset_snapshot.exists():
+            snapshot_mismatch = EvaluationDataset.get_snapshot_mismatch(
+                dataset_snapshot, dir_dataset
+            )
+            if snapshot_mismatch is not None:
+                logger.warning(
+                    f"Dataset snapshot {dataset_snapshot} is rebuilt : {snapshot_mismatch}"
+                )
+        if snapshot_mismatch is None:
+            dataset = EvaluationDataset.load_snapshot(dataset_snapshot)
+        else:
+            dataset = EvaluationDataset(
+                datapath=dir_dataset,
+                dataset_ID=dir_dataset.stem,
+            )
+            dataset.dump()
+            if dataset_snapshot:
+                dataset.save_snapshot(dataset_snapshot)
 
         # Launch Evaluation
 
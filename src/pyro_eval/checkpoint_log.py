@@ -0,0 +1,75 @@
+import json
+import logging
+import os
+
+import numpy as np
+import pandas as pd
+
+
+class CheckpointLog:
+    """
+    Append-only log of results, one json line per completed unit of work (a sequence for the engine).
+    Each record is flushed and fsync'd before append() returns, so a record is either fully on disk or
+    truncated at the next load if the process crashed while writing it.
+    Records contain columns of the same length, which are gathered in a dataframe with the given dtypes.
+    """
+
+    def __init__(self, path, dtypes: dict = None):
+        self.path = str(path)
+        self.dtypes = dtypes or {}
+
+    def load(self):
+        """
+        Reads the log, returns the set of completed keys and a dataframe of the logged rows (None if empty).
+        A partially written last record is removed from the file.
+        """
+        keys = set()
+        columns = {}
+        if not os.path.isfile(self.path):
+            return keys, None
+
+        valid_size = 0
+        with open(self.path, "rb") as fp:
+            for line in fp:
+                try:
+                    if not line.endswith(b"\n"):
+                        raise ValueError("incomplete record")
+                    record = json.loads(line)
+                except ValueError as e:
+                    logging.warning(
+                        f"Checkpoint log {self.path} truncated after {len(keys)} records : {e}"
+                    )
+                    break
+                keys.add(record["key"])
+                for name, values in record["columns"].items():
+                    columns.setdefault(name, []).extend(values)
+                valid_size += len(line)
+
+        if valid_size < os.path.getsize(self.path):
+            # Later records are appended after the last complete one
+            with open(self.path, "r+b") as fp:
+                fp.truncate(valid_size)
+
+        if not keys:
+            return keys, None
+        dataframe = pd.DataFrame(columns)
+        return keys, dataframe.astype(
+            {name: dtype for name, dtype in self.dtypes.items() if name in dataframe}
+        )
+
+    def append(self, key, columns: dict):
+        """
+        Durably appends the record of a completed key
+        """
+        record = {
+            "key": key,
+            "columns": {
+                name: values.tolist() if isinstance(values, np.ndarray) else list(values)
+                for name, values in columns.items()
+            },
+        }
+        line = json.dumps(record, default=str) + "\n"
+        with open(self.path, "a") as fp:
+            fp.write(line)
+            fp.flush()
+            os.fsync(fp.fileno())
@@ -1,104 +1,462 @@
-import hashlib
 import logging
 import os
-from dataclasses import dataclass, field
+from datetime import datetime
+from io import BytesIO
 from typing import List, Optional
 
 import numpy as np
+import pandas as pd
 from PIL import Image as PILImage
 
-from .utils import parse_date_from_filepath, xywh2xyxy
+from .utils import (
+    combine_hashes,
+    compute_file_hash,
+    parse_date_from_filepath,
+    reduce_image,
+    xywh2xyxy,
+)
+
+
+class BoxStore:
+    """
+    Ground truth boxes of a list of images, parsed once and stored in a single contiguous float32 (N, 5) array.
+    Each row is a box formatted as [class_id, x1, y1, x2, y2], rows offsets[i]:offsets[i + 1] belong to image i.
+    """
+
+    def __init__(self, boxes: np.ndarray, offsets: np.ndarray):
+        self.boxes = boxes
+        self.offsets = offsets
+
+    @classmethod
+    def from_annotations(cls, annotations, image_paths=None):
+        """
+        Parses YOLO label lines ("class_id x_center y_center width height") of each image,
+        and converts all boxes to xyxy format at once.
+        """
+        values, counts = [], []
+        for i, lines in enumerate(annotations):
+            count = 0
+            for line in lines:
+                try:
+                    box = [float(value) for value in line.split()[:5]]
+                except ValueError:
+                    box = []
+                if len(box) != 5:
+                    image_path = image_paths[i] if image_paths is not None else i
+                    logging.warning(f"Failed to parse box '{line.strip()}' for image {image_path}")
+                    continue
+                values.append(box)
+                count += 1
+            counts.append(count)
+
+        boxes = np.array(values, dtype=np.float32).reshape(-1, 5)
+        # Translate into xyxy coordinates, columns are passed as rows to convert all boxes at once
+        boxes[:, 1:] = xywh2xyxy(boxes[:, 1:].T).T
+
+        offsets = np.zeros(len(counts) + 1, dtype=np.int64)
+        np.cumsum(counts, out=offsets[1:])
+
+        return cls(boxes, offsets)
+
+    def __getitem__(self, index) -> np.ndarray:
+        """
+        Returns the (K, 5) boxes of an image, as a view on the store
+        """
+        return self.boxes[self.offsets[index] : self.offsets[index + 1]]
+
+    def take(self, indices) -> "BoxStore":
+        """
+        Returns a new store with the boxes of the given images, in the given order
+        """
+        indices = np.asarray(indices, dtype=np.int64)
+        counts = self.offsets[indices + 1] - self.offsets[indices]
+        offsets = np.zeros(len(indices) + 1, dtype=np.int64)
+        np.cumsum(counts, out=offsets[1:])
+        # Row r of image k in the new store is row r - offsets[k] + self.offsets[indices[k]]
+        rows = np.arange(offsets[-1]) - np.repeat(
+            offsets[:-1] - self.offsets[indices], counts
+        )
+        return BoxStore(self.boxes[rows], offsets)
+
+    @classmethod
+    def concatenate(cls, stores: List["BoxStore"]) -> "BoxStore":
+        """
+        Returns a store with the images of all stores, in order
+        """
+        counts = np.concatenate([np.diff(store.offsets) for store in stores])
+        offsets = np.zeros(len(counts) + 1, dtype=np.int64)
+        np.cumsum(counts, out=offsets[1:])
+        boxes = np.concatenate([store.boxes for store in stores]).reshape(-1, 5)
+        return cls(boxes.astype(np.float32, copy=False), offsets)
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+
+class ImageTable:
+    """
+    Struct-of-arrays storage of images : each attribute is stored in a typed column and an image is a row index.
+    CustomImage and Sequence objects are lightweight views on this table.
+    """
+
+    def __init__(
+        self,
+        paths: np.ndarray,
+        sequence_ids: np.ndarray,
+        timedeltas: np.ndarray,
+        timestamps: np.ndarray,
+        hashes: np.ndarray,
+        boxes: np.ndarray,
+        box_store: BoxStore,
+        row_indices: Optional[np.ndarray] = None,
+        hf_images=None,
+    ):
+        self.paths = paths  # object array of image paths
+        self.sequence_ids = sequence_ids  # object array of sequence names
+        self.timedeltas = timedeltas  # timedelta64[ns] array, time elapsed since the sequence start
+        self.timestamps = timestamps  # datetime64[ns] array, capture dates (NaT if unknown)
+        self.hashes = hashes  # object array of image hashes
+        self.boxes = boxes  # object array of annotation lines (List[str]) of each image
+        self.box_store = box_store  # parsed boxes, one entry per image
+        self.row_indices = row_indices  # rows of the images in hf_images, for hugging face datasets
+        self.hf_images = hf_images  # Arrow-backed dataset from which images are decoded
+        self.labels = np.fromiter(
+            (len(lines) > 0 for lines in boxes), dtype=bool, count=len(boxes)
+        )
+        self.predictions = np.full(len(paths), None, dtype=object)
+
+    @classmethod
+    def from_dataframe(cls, dataframe: pd.DataFrame, box_store: BoxStore, hf_images=None):
+        """
+        Builds a table from a dataset dataframe, rows of box_store must follow the dataframe rows
+        """
+        return cls(
+            paths=dataframe["image"].to_numpy(),
+            sequence_ids=dataframe["sequence_id"].to_numpy(),
+            timedeltas=dataframe["delta"].to_numpy(dtype="timedelta64[ns]"),
+            timestamps=dataframe["timestamp"].to_numpy(dtype="datetime64[ns]"),
+            hashes=dataframe["hash"].to_numpy(),
+            boxes=dataframe["boxes"].to_numpy(),
+            box_store=box_store,
+            row_indices=(
+                dataframe["row_index"].to_numpy() if "row_index" in dataframe else None
+            ),
+            hf_images=hf_images,
+        )
+
+    def take(self, indices) -> "ImageTable":
+        """
+        Returns a new table with the given rows, in the given order. Predictions are copied.
+        """
+        indices = np.asarray(indices, dtype=np.int64)
+        table = ImageTable(
+            paths=self.paths[indices],
+            sequence_ids=self.sequence_ids[indices],
+            timedeltas=self.timedeltas[indices],
+            timestamps=self.timestamps[indices],
+            hashes=self.hashes[indices],
+            boxes=self.boxes[indices],
+            box_store=self.box_store.take(indices),
+            row_indices=self.row_indices[indices] if self.row_indices is not None else None,
+            hf_images=self.hf_images,
+        )
+        table.predictions = self.predictions[indices]
+        return table
+
+    @classmethod
+    def from_images(cls, images: List["CustomImage"]) -> "ImageTable":
+        """
+        Gathers images, that may be views on different tables, in a new table.
+        The new table only holds these images, which makes it cheap to send to another process.
+        """
+        tables, indices = [], []
+        for image in images:
+            if not tables or image.table is not tables[-1]:
+                tables.append(image.table)
+                indices.append([])
+            indices[-1].append(image.index)
+        if not tables:
+            raise ValueError("No image to gather in a table.")
+
+        parts = [table.take(rows) for table, rows in zip(tables, indices)]
+        if len({id(part.hf_images) for part in parts}) > 1:
+            raise ValueError("Images from different hugging face datasets can not be gathered in a table.")
+        has_row_indices = parts[0].row_indices is not None
+
+        table = cls(
+            paths=np.concatenate([part.paths for part in parts]),
+            sequence_ids=np.concatenate([part.sequence_ids for part in parts]),
+            timedeltas=np.concatenate([part.timedeltas for part in parts]),
+            timestamps=np.concatenate([part.timestamps for part in parts]),
+            hashes=np.concatenate([part.hashes for part in parts]),
+            boxes=np.concatenate([part.boxes for part in parts]),
+            box_store=BoxStore.concatenate([part.box_store for part in parts]),
+            row_indices=(
+                np.concatenate([part.row_indices for part in parts]) if has_row_indices else None
+            ),
+            hf_images=parts[0].hf_images,
+        )
+        table.predictions = np.concatenate([part.predictions for part in parts])
+        return table
+
+    def __len__(self):
+        return len(self.paths)
+
+
+def object_array(values: list) -> np.ndarray:
+    """
+    Creates a 1D object array, even if values are lists of the same length
+    """
+    array = np.empty(len(values), dtype=object)
+    for i, value in enumerate(values):
+        array[i] = value
+    return array
 
 
-@dataclass
 class CustomImage:
     """
-    Dataclass for a custom image object that gathers data about each image : bytes, annotations, origin sequence
+    Custom image object that gathers data about each image : bytes, annotations, origin sequence
+    Images of a dataset are stored by columns in an ImageTable and a CustomImage is a view on one of its rows,
+    see CustomImage.view(). A standalone CustomImage can also be created from its attributes.
     """
 
-    path: str
-    sequence_id: str
-    timedelta: float
-    boxes: List[str]
+    __slots__ = ("table", "index")
 
-    timestamp: str = field(init=False)
-    hash: str = field(init=False)
-    prediction: Optional[str] = field(default=None) # Formatted as a 5-array of predictions [[boxes.xyxyn, conf]]
+    def __init__(
+        self,
+        path: str,
+        sequence_id: str,
+        timedelta: float,
+        boxes: List[str],
+        timestamp: Optional[datetime] = None, # Parsed from the filename if not provided
+        hash: Optional[str] = None, # Computed from the file if not provided
+        prediction: Optional[str] = None, # Formatted as a 5-array of predictions [[boxes.xyxyn, conf]]
+        source: Optional["ArrowImageSource"] = None, # Set when the image is not a local file
+        box_array: Optional[np.ndarray] = None, # (K, 5) boxes, parsed from boxes if not provided
+    ):
+        if timestamp is None:
+            timestamp = parse_date_from_filepath(path)["date"]
+        if hash is None:
+            hash = compute_file_hash(path)
+        box_store = (
+            BoxStore.from_annotations([boxes], [path])
+            if box_array is None
+            else BoxStore(box_array, np.array([0, len(box_array)], dtype=np.int64))
+        )
 
-    def __post_init__(self):
-        self.timestamp = parse_date_from_filepath(self.path)["date"]
-        self.hash = self.compute_hash()
-        self.label: bool = len(self.boxes) > 0
-        self.name: str = os.path.basename(self.path)
+        # A standalone image is stored in its own single-row table
+        self.table = ImageTable(
+            paths=object_array([path]),
+            sequence_ids=object_array([sequence_id]),
+            timedeltas=pd.to_timedelta([timedelta]).to_numpy(),
+            timestamps=pd.to_datetime([timestamp]).to_numpy(dtype="datetime64[ns]"),
+            hashes=object_array([hash]),
+            boxes=object_array([boxes]),
+            box_store=box_store,
+            row_indices=np.array([source.row_index]) if source else None,
+            hf_images=source.dataset if source else None,
+        )
+        self.index = 0
+        self.prediction = prediction
 
-    def load(self) -> PILImage.Image:
+    @classmethod
+    def view(cls, table: ImageTable, index: int) -> "CustomImage":
+        """
+        Returns the image stored at row index of the table, without copying any data
+        """
+        image = cls.__new__(cls)
+        image.table = table
+        image.index = index
+        return image
+
+    @property
+    def path(self):
+        return self.table.paths[self.index]
+
+    @property
+    def sequence_id(self) -> str:
+        return self.table.sequence_ids[self.index]
+
+    @property
+    def timedelta(self) -> pd.Timedelta:
+        return pd.Timedelta(self.table.timedeltas[self.index])
+
+    @property
+    def timestamp(self) -> Optional[pd.Timestamp]:
+        timestamp = self.table.timestamps[self.index]
+        return None if np.isnat(timestamp) else pd.Timestamp(timestamp)
+
+    @property
+    def hash(self) -> str:
+        return self.table.hashes[self.index]
+
+    @property
+    def boxes(self) -> List[str]:
+        return self.table.boxes[self.index]
+
+    @property
+    def label(self) -> bool:
+        return bool(self.table.labels[self.index])
+
+    @property
+    def name(self) -> str:
+        return os.path.basename(self.path)
+
+    @property
+    def prediction(self):
+        return self.table.predictions[self.index]
+
+    @prediction.setter
+    def prediction(self, prediction):
+        self.table.predictions[self.index] = prediction
+
+    @property
+    def source(self) -> Optional["ArrowImageSource"]:
+        if self.table.hf_images is None:
+            return None
+        return ArrowImageSource(self.table.hf_images, self.table.row_indices[self.index])
+
+    @property
+    def box_array(self) -> np.ndarray:
+        """
+        (K, 5) array of [class_id, x1, y1, x2, y2] boxes, view on the BoxStore of the table
+        """
+        return self.table.box_store[self.index]
+
+    @property
+    def boxes_xyxy(self) -> np.ndarray:
+        """
+        Returns a (K, 4) array of bounding boxes coordinates in xyxy format.
+        This is a view on the BoxStore of the table, boxes are parsed only once.
+        """
+        return self.box_array[:, 1:]
+
+    def load(self, target_size=None) -> PILImage.Image:
         """
         Load image only when needed
+        If target_size is provided, the image is downscaled so that its longest side matches the model input size.
+        JPEG images are then decoded at a reduced resolution, which is much cheaper than a full decode.
         """
+        source = self.source
         try:
-            image = PILImage.open(self.path)
+            image = source.load() if source else PILImage.open(self.path)
+            image = reduce_image(image, target_size)
         except:
             image = None
             logging.error(f"Unable to load image : {self.path}")
         return image
 
     def compute_hash(self):
-        hash_md5 = hashlib.md5()
-        with open(self.path, "rb") as f:
-            for chunk in iter(lambda: f.read(4096), b""):
-                hash_md5.update(chunk)
-        return hash_md5.hexdigest()
+        return compute_file_hash(self.path)
 
-    @property
-    def boxes_xyxy(self):
+    def __repr__(self):
+        return (
+            f"CustomImage(path={self.path!r}, sequence_id={self.sequence_id!r}, "
+            f"timedelta={self.timedelta!r}, label={self.label})"
+        )
+
+
+class ArrowImageSource:
+    """
+    Reference to an image stored in an Arrow-backed hugging face dataset.
+    The image is decoded from the Arrow buffers only when loaded.
+    """
+
+    def __init__(self, dataset, row_index: int):
+        self.dataset = dataset  # Hugging Face dataset with an undecoded "image" column (bytes and path)
+        self.row_index = int(row_index)
+
+    def load(self) -> PILImage.Image:
         """
-        Returns a list of bounding boxes coordinates in xyxy format.
+        Opens the image without decoding it, like PIL.Image.open, so that it can be decoded at a reduced size
         """
-        # Handle empty case safely
-        if not self.boxes:
-            return []
-        try:
-            # Remove trailing \n, whitespaces, first value of the predicted array (class id) for each box
-            boxes = [
-                np.array(box.strip().split(" ")[1:5]).astype(float)
-                for box in self.boxes
-            ]
-            # Translate into xyxy coordinates and return
-            return [xywh2xyxy(box) for box in boxes]
-        except Exception as e:
-            logging.warning(f"Failed to parse boxes for image {self.path}: {e}")
-            return []
+        image = self.dataset[self.row_index]["image"]
+        if image["bytes"] is not None:
+            return PILImage.open(BytesIO(image["bytes"]))
+        return PILImage.open(image["path"])
 
 
 class Sequence:
     """
     Objects that contains a list of images from a single sequence
+    In a dataset, a Sequence is a view on the contiguous rows start:stop of an ImageTable.
+    It can also be created from a list of CustomImage.
     """
 
-    def __init__(self, sequence_id: str, images: list[CustomImage] = []):
+    __slots__ = ("sequence_id", "table", "start", "stop", "_images")
+
+    def __init__(
+        self,
+        sequence_id: str,
+        images: Optional[list[CustomImage]] = None,
+        table: Optional[ImageTable] = None,
+        start: int = 0,
+        stop: Optional[int] = None,
+    ):
         self.sequence_id = sequence_id
-        self.images = images
-        self.sequence_start = self.images[0].timestamp
+        self.table = table
+        self.start = start
+        self.stop = stop if stop is not None or table is None else len(table)
+        # Images are only stored in a list for sequences that are not backed by a table
+        self._images = list(images or []) if table is None else None
+
+    @property
+    def images(self) -> tuple[CustomImage, ...]:
+        """
+        Images of the sequence, as a tuple : images are added with add_image()
+        """
+        if self._images is not None:
+            return tuple(self._images)
+        return tuple(CustomImage.view(self.table, index) for index in range(self.start, self.stop))
+
+    @property
+    def sequence_start(self):
+        """
+        Timestamp of the first image of the sequence
+        """
+        if self._images is not None:
+            return self._images[0].timestamp
+        return CustomImage.view(self.table, self.start).timestamp
 
     @property
     def label(self):
         """
         Define label as property as it needs to be recomputed for each image added or removed
         """
-        return any(image.label for image in self.images)
+        if self._images is not None:
+            return any(image.label for image in self._images)
+        return bool(self.table.labels[self.start : self.stop].any())
+
+    @property
+    def hash(self):
+        """
+        Sequence hash, combines the hashes of its images
+        """
+        if self._images is not None:
+            return combine_hashes(image.hash for image in self._images)
+        return combine_hashes(self.table.hashes[self.start : self.stop])
 
     def get_sequence_label(self):
-        image_labels = [image.label for image in self.images]
-        return any(image_labels)
+        return self.label
 
     def add_image(self, image_path, sequence_id, timedelta, label):
-        self.images.append(CustomImage(image_path, sequence_id, timedelta, label))
+        if self._images is None:
+            # The sequence is detached from its table to be extended
+            self._images = list(self.images)
+            self.table = None
+        self._images.append(CustomImage(image_path, sequence_id, timedelta, label))
 
     def __len__(self):
-        return len(self.images)
+        if self._images is not None:
+            return len(self._images)
+        return self.stop - self.start
 
     def __iter__(self):
         """
         for image in sequence: will iterate over CustomImages in self.images
         """
-        return iter(self.images)
+        if self._images is not None:
+            return iter(self._images)
+        return (
+            CustomImage.view(self.table, index) for index in range(self.start, self.stop)
+        )
@@ -1,47 +1,68 @@
 import hashlib
 import logging
 import os
-from collections import defaultdict
-from datetime import datetime, timedelta
+from datetime import datetime
 from pathlib import Path
 
 import matplotlib.pyplot as plt
+import numpy as np
 import pandas as pd
-from datasets import load_dataset
+from datasets import DatasetDict, concatenate_datasets, load_dataset, load_from_disk
+from datasets import Image as HFImage
 from huggingface_hub import HfApi, HfFolder
 
-from .data_structures import CustomImage, Sequence
+from .data_structures import BoxStore, ImageTable, Sequence
+from .hash_cache import ImageHashCache
 from .utils import (
     EXTENSIONS,
-    has_image_extension,
+    combine_hashes,
+    compute_file_hash,
+    compute_source_stats,
+    decode_strings,
+    encode_strings,
+    is_arrow_dataset,
     is_image,
-    parse_date_from_filepath,
+    parse_dates_from_filepaths,
     replace_extension,
 )
 
 
+HASH_CACHE_FILENAME = ".hash_cache.json"
+SNAPSHOT_VERSION = 3
+HF_BATCH_SIZE = 1000
+
+
 class EvaluationDataset:
     """
     Class that contains a dataset and metadata.
     It can be instantiated either with a local image folder or a hugging face repo
     """
 
-    def __init__(self, datapath, dataset_ID=None):
+    def __init__(self, datapath, dataset_ID=None, split="all"):
 
         self.datapath = datapath
+        self.split = split
         self.sequences: list[Sequence] = []
+        self.all_images = None
         self.is_local: bool = os.path.exists(
             self.datapath
         )  # False if datapath is a HF repo
+        # Arrow-backed dataset from which Hugging Face images are decoded when loaded
+        self.hf_images = None
 
         if not self.datapath:
             raise ValueError("No datapath provided to instanciate EvaluationDataset.")
 
-        # Retrieve data from a local directory or a huggingface repository
+        # Retrieve data from a local directory or a huggingface repository (remote or local copy)
         self.dataframe = (
-            self.init_from_folder() if self.is_local else self.init_from_hugging_face()
+            self.init_from_folder()
+            if self.is_local and not is_arrow_dataset(self.datapath)
+            else self.init_from_hugging_face(split)
         )
 
+        # Retrieve image hashes, unchanged images are read from the hash cache
+        self.dataframe["hash"] = self.get_image_hashes()
+
         # Build dataset from Sequence and CustomImage objects
         self.build_dataset()
         self.hash = self.compute_hash()
@@ -54,11 +75,31 @@ class EvaluationDataset:
         # Check that all image hashes are unique in the dataset
         self.check_unique_hashes()
 
-    def init_from_hugging_face(self, split="all"):
+    def load_hugging_face_dataset(self, split="all"):
         """
-        Builds a dataset dataframe from a huggingface repository.
+        Opens an Arrow-backed hugging face dataset, either from a local copy (saved with save_to_disk or
+        stored as parquet files) or from a hugging face repository.
         The repository is private so it requires authentification, use "huggingface-cli login" to authenticate.
         """
+        if self.is_local:
+            datapath = str(self.datapath)
+            parquet_files = (
+                [datapath]
+                if os.path.isfile(datapath)
+                else [str(path) for path in sorted(Path(datapath).glob("**/*.parquet"))]
+            )
+            if parquet_files:
+                return load_dataset("parquet", data_files=parquet_files, split="train")
+
+            hf_dataset = load_from_disk(datapath)
+            if isinstance(hf_dataset, DatasetDict):
+                hf_dataset = (
+                    concatenate_datasets(list(hf_dataset.values()))
+                    if split == "all"
+                    else hf_dataset[split]
+                )
+            return hf_dataset
+
         token = HfFolder.get_token()
         if token is None:
             raise ValueError(
@@ -75,16 +116,67 @@ class EvaluationDataset:
                 f"Error : {self.datapath} doesn't exist or is not accessible."
             )
 
-        # TODO : this needs memory management and optimization
-        hf_dataset = load_dataset(dataset_id, split=split, trust_remote_code=True)
+        return load_dataset(dataset_id, split=split, trust_remote_code=True)
 
-        # Retrieve images, annotations and dates as lists
-        image_list = [element["image"] for element in hf_dataset]
-        annotations = [element["annotations"] for element in hf_dataset]
-        dates = [element["date"] for element in hf_dataset]
+    @staticmethod
+    def select_hf_images(hf_dataset):
+        """
+        Returns the image column of a hugging face dataset, without automatic decoding : rows give the image
+        bytes and path, images are opened by ArrowImageSource when they are loaded.
+        """
+        return hf_dataset.select_columns(["image"]).cast_column("image", HFImage(decode=False))
+
+    def init_from_hugging_face(self, split="all"):
+        """
+        Builds a dataset dataframe from a huggingface dataset.
+        The Arrow-backed dataset is iterated by batches and only metadata is kept in memory : image names,
+        hashes, annotations and dates. Images are decoded from the Arrow buffers when they are loaded.
+        """
+        hf_dataset = self.load_hugging_face_dataset(split)
+        self.hf_images = self.select_hf_images(hf_dataset)
+
+        # Image bytes are hashed without decoding the images
+        image_list, hashes = [], []
+        for batch in self.hf_images.iter(batch_size=HF_BATCH_SIZE):
+            for image in batch["image"]:
+                if image["bytes"] is not None:
+                    image_hash = hashlib.md5(image["bytes"]).hexdigest()
+                else:
+                    image_hash = compute_file_hash(image["path"])
+                hashes.append(image_hash)
+                # Image names are used as identifiers, indices are used for images without a name
+                image_list.append(
+                    os.path.basename(image["path"])
+                    if image["path"]
+                    else f"{len(image_list)}.jpg"
+                )
+
+        annotations, dates = [], []
+        metadata = hf_dataset.select_columns(["annotations", "date"])
+        for batch in metadata.iter(batch_size=HF_BATCH_SIZE):
+            annotations.extend(
+                [
+                    [box for box in boxes.split("\n") if len(box) > 0]
+                    if isinstance(boxes, str)
+                    else list(boxes or [])
+                    for boxes in batch["annotations"]
+                ]
+            )
+            dates.extend(batch["date"])
+
+        prefixes, _ = parse_dates_from_filepaths(image_list)
+        dates = pd.to_datetime(pd.Series(dates), errors="coerce")
+        self.nb_invalid_images = int(dates.isna().sum())
+        logging.info(f"No timestamp found on {self.nb_invalid_images} images.")
 
         # Identify common sequence and store data in a dataframe
-        return self.determine_sequences(image_list, annotations, dates)
+        return self.determine_sequences(
+            image_list,
+            annotations,
+            dates,
+            prefixes=prefixes,
+            extra_columns={"row_index": np.arange(len(image_list)), "hash": hashes},
+        )
 
     def init_from_folder(self):
         """
@@ -94,141 +186,323 @@ class EvaluationDataset:
         if not os.path.isdir(self.datapath):
             raise FileNotFoundError(f"{self.datapath} is not a directory.")
 
-        def load_annotation(image_path):
-            """
-            Loads boxes coordinnates from a txt file.
-            """
-            # Get labels folder
-            annotation_file = str(image_path).replace("/images/", "/labels/")
-            # Change file extension to .txt
-            annotation_file = replace_extension(annotation_file, EXTENSIONS, ".txt")
-
-            if not os.path.isfile(annotation_file):
-                boxes = []
-            else:
-                with open(annotation_file, "r") as file:
-                    boxes = file.read().split("\n")
-                    boxes = [box for box in boxes if len(box) > 0]
-
-            return boxes
-
         image_filepaths = list((Path(self.datapath) / "images").glob("**/*.jpg"))
         logging.info(f"Found {len(image_filepaths)} images in dataset")
         image_list = [image for image in sorted(image_filepaths) if is_image(image)]
-        annotations = [load_annotation(image_path) for image_path in image_list]
-        timestamps = [
-            parse_date_from_filepath(image_path).get("date", None)
-            for image_path in image_list
-        ]
-        self.nb_invalid_images = timestamps.count(None)
+        # Annotation files are stat'ed before being read, refresh() only reads them again if they changed
+        self.label_stats = {str(image_path): self.stat_annotation(image_path) for image_path in image_list}
+        annotations = [self.load_annotation(image_path) for image_path in image_list]
+        # Each filename is parsed once to retrieve the camera prefix and the capture date
+        prefixes, timestamps = parse_dates_from_filepaths(image_list)
+        self.nb_invalid_images = int(np.isnat(timestamps).sum())
         logging.info(f"No timestamp found on {self.nb_invalid_images} images.")
 
-        # TODO : investigate storing the 3 lists above in an OrderedDict
-        self.images_info = {
-            image_path: {
-                "prefix": parse_date_from_filepath(image_path).get("prefix", None),
-                "date": parse_date_from_filepath(image_path).get("date", None),
-            }
-            for image_path in image_list
-        }
-
         # Identify common sequence and store data in a dataframe
-        dataframe = self.determine_sequences(image_list, annotations, timestamps)
+        dataframe = self.determine_sequences(
+            image_list, annotations, timestamps, prefixes=prefixes
+        )
 
         return dataframe
 
-    def build_dataset(self):
+    @staticmethod
+    def get_annotation_path(image_path):
+        # Get labels folder
+        annotation_file = str(image_path).replace("/images/", "/labels/")
+        # Change file extension to .txt
+        return replace_extension(annotation_file, EXTENSIONS, ".txt")
+
+    @classmethod
+    def load_annotation(cls, image_path):
         """
-        Create Sequence and CustomImage objects from dataset dataframe
-        Each Sequence contains a list of CustomImage, the dataset contains a dict with all sequences
+        Loads boxes coordinnates from a txt file.
+        """
+        annotation_file = cls.get_annotation_path(image_path)
+        if not os.path.isfile(annotation_file):
+            boxes = []
+        else:
+            with open(annotation_file, "r") as file:
+                boxes = file.read().split("\n")
+                boxes = [box for box in boxes if len(box) > 0]
+
+        return boxes
+
+    @classmethod
+    def stat_annotation(cls, image_path):
         """
+        Returns the size and modification time of the annotation file of an image, None if it has none
+        """
+        try:
+            stat = os.stat(cls.get_annotation_path(image_path))
+        except FileNotFoundError:
+            return None
+        return [stat.st_size, stat.st_mtime_ns]
 
-        for sequence_id, sequence_df in self.dataframe.groupby("sequence_id"):
-            custom_images = [
-                CustomImage(
-                    path=row["image"],
-                    sequence_id=sequence_id,
-                    timedelta=row["delta"],
-                    boxes=row["boxes"],
-                )
-                for _, row in sequence_df.iterrows()
-            ]
+    def build_dataset(self, box_store=None):
+        """
+        Create Sequence and CustomImage objects from dataset dataframe
+        Images are stored by columns in an ImageTable, sorted by sequence so that each Sequence is a view on
+        a contiguous range of rows. The dataframe, self.box_store and self.image_table share the same row order.
+        box_store, if provided, must follow the rows of the dataframe before sorting.
+        """
+        order = np.argsort(self.dataframe["sequence_id"].to_numpy(), kind="stable")
+        self.dataframe = self.dataframe.iloc[order].reset_index(drop=True)
+        self.box_store = (
+            box_store.take(order) if box_store is not None else self.build_box_store()
+        )
+        self.image_table = ImageTable.from_dataframe(
+            self.dataframe, self.box_store, self.hf_images
+        )
 
-            self.sequences.append(Sequence(sequence_id, images=custom_images))
+        # Sequence boundaries are the rows where the sequence_id changes
+        sequence_ids = self.image_table.sequence_ids
+        starts = np.flatnonzero(
+            np.concatenate([[True], sequence_ids[1:] != sequence_ids[:-1]])
+        )[: len(sequence_ids)]
+        stops = np.append(starts[1:], len(sequence_ids))
+        self.sequences = [
+            Sequence(
+                sequence_ids[start],
+                table=self.image_table,
+                start=int(start),
+                stop=int(stop),
+            )
+            for start, stop in zip(starts, stops)
+        ]
+        self.all_images = None
 
-    def determine_sequences(self, image_list, annotations, timestamps, max_delta=30):
+    def build_box_store(self):
         """
-        Parse images to detect files belonging to the same sequence by comparing camera name and capture dates.
-        Expects file named as *_year_month_daythour_*
+        Parses the ground truth boxes of all images at once, rows of the store follow the dataframe rows
         """
+        return BoxStore.from_annotations(self.dataframe["boxes"], self.dataframe["image"].to_numpy())
 
-        data = []
-        current_sequence = None
+    def refresh(self):
+        """
+        Rescans the dataset folder to take added, removed, modified and relabeled images into account.
+        The dataset is updated incrementally :
+        - images are listed and stat'ed, only new or modified images are hashed (see ImageHashCache)
+        - annotation files are only read if their size or modification time changed
+        - sequences are only determined again for the cameras that gained, lost, modified or relabeled images,
+          the rows, parsed boxes and sequence hashes of other cameras are kept as they are
+        The image table is reassembled from the kept and rebuilt rows, predictions of unchanged images are kept.
+        Returns the paths of added, removed and modified images and the ids of added, removed and modified
+        sequences, so that results depending on a sequence hash can be invalidated selectively.
+        """
+        if not self.is_local or self.hf_images is not None:
+            raise ValueError("Only datasets built from a local image folder can be refreshed.")
 
-        for image_path, boxes, timestamp in zip(image_list, annotations, timestamps):
-            # TODO : Better handle images without timestamps
-            if not has_image_extension(image_path) or not timestamp:
-                logging.info(
-                    f"Skipping {image_path} : wrong extension or unable to retrieve timestamp."
-                )
+        image_list = [
+            image for image in sorted((Path(self.datapath) / "images").glob("**/*.jpg")) if is_image(image)
+        ]
+        prefixes, timestamps = parse_dates_from_filepaths(image_list)
+        # Images without timestamp are not part of the dataset, see determine_sequences
+        valid = ~np.isnat(timestamps)
+        self.nb_invalid_images = int(np.count_nonzero(~valid))
+        image_list = [image for image, is_valid in zip(image_list, valid) if is_valid]
+        prefixes, timestamps = prefixes[valid], timestamps[valid]
+        paths = np.array([str(image) for image in image_list], dtype=object)
+        hash_cache = ImageHashCache(os.path.join(self.datapath, HASH_CACHE_FILENAME))
+        hashes = np.array(hash_cache.get_hashes(image_list, full_scan=True), dtype=object)
+
+        # Current images are matched with the rows of the dataset by path
+        previous_paths = self.dataframe["image"].map(str).to_numpy()
+        previous_rows = pd.Index(previous_paths).get_indexer(paths)
+        common = previous_rows >= 0
+        is_current = np.zeros(len(previous_paths), dtype=bool)
+        is_current[previous_rows[common]] = True
+        modified = common.copy()
+        modified[common] = self.dataframe["hash"].to_numpy()[previous_rows[common]] != hashes[common]
+
+        # Datasets loaded from a snapshot have no annotation stats, their annotation files are all read once
+        previous_label_stats = getattr(self, "label_stats", None) or {}
+        label_stats = {path: self.stat_annotation(path) for path in paths}
+        previous_boxes = self.dataframe["boxes"].to_numpy()
+        annotations = [None] * len(paths)
+        relabeled = np.zeros(len(paths), dtype=bool)
+        for i, path in enumerate(paths):
+            if common[i] and path in previous_label_stats and previous_label_stats[path] == label_stats[path]:
+                annotations[i] = previous_boxes[previous_rows[i]]
                 continue
+            annotations[i] = self.load_annotation(path)
+            relabeled[i] = common[i] and annotations[i] != previous_boxes[previous_rows[i]]
 
-            # TODO : Date format to standardize
-            image_prefix = self.images_info.get(image_path, {}).get("prefix")
-
-            if not current_sequence:
-                current_sequence = os.path.splitext(os.path.basename(image_path))[0]
-                sequence_images = [(image_path, timestamp, boxes)]
-                sequence_start = timestamp
-                previous_image_timestamp = timestamp
-                previous_prefix = image_prefix
-            else:
-                if (timestamp - previous_image_timestamp) <= timedelta(
-                    minutes=max_delta
-                ) and image_prefix == previous_prefix:
-                    sequence_images.append((image_path, timestamp, boxes))
-                else:
-                    # More than 30 min between two captures -> Save current sequence and start a new one
-                    for im_path, im_timestamp, im_boxes in sequence_images:
-                        data.append(
-                            {
-                                "image": im_path,
-                                "sequence_id": current_sequence,
-                                "boxes": im_boxes,
-                                "delta": im_timestamp - sequence_start,
-                            }
-                        )
-
-                    current_sequence = os.path.splitext(os.path.basename(image_path))[0]
-                    sequence_images = [(image_path, timestamp, boxes)]
-                    sequence_start = timestamp
-                previous_image_timestamp = timestamp
-                previous_prefix = image_prefix
-        # Save last sequence
-        if sequence_images:
-            for image_path, timestamp, boxes in sequence_images:
-                data.append(
-                    {
-                        "image": image_path,
-                        "sequence_id": current_sequence,
-                        "boxes": boxes,
-                        "delta": timestamp - sequence_start,
-                    }
+        # Sequences never span several cameras : only cameras with a changed image are segmented again
+        previous_prefixes, _ = parse_dates_from_filepaths(previous_paths)
+        changed_prefixes = set(prefixes[~common | modified | relabeled]) | set(
+            previous_prefixes[~is_current]
+        )
+        if changed_prefixes:
+            previous_table = self.image_table
+            previous_sequence_hashes = self.sequence_hashes
+            kept_rows = np.flatnonzero(~pd.Series(previous_prefixes).isin(changed_prefixes).to_numpy())
+            rebuilt_rows = np.flatnonzero(pd.Series(prefixes).isin(changed_prefixes).to_numpy())
+
+            kept_dataframe = self.dataframe.iloc[kept_rows].drop(columns="sequence_label")
+            rebuilt_dataframe = self.determine_sequences(
+                [image_list[i] for i in rebuilt_rows],
+                [annotations[i] for i in rebuilt_rows],
+                timestamps[rebuilt_rows],
+                prefixes=prefixes[rebuilt_rows],
+                extra_columns={"hash": hashes[rebuilt_rows]},
+            )
+            self.dataframe = pd.concat([kept_dataframe, rebuilt_dataframe], ignore_index=True)
+            # Boxes of kept rows are not parsed again
+            self.build_dataset(
+                box_store=BoxStore.concatenate(
+                    [
+                        self.box_store.take(kept_rows),
+                        BoxStore.from_annotations(
+                            rebuilt_dataframe["boxes"], rebuilt_dataframe["image"].to_numpy()
+                        ),
+                    ]
                 )
+            )
 
-        df = pd.DataFrame(data)
-        return df
+            # Only the hashes of rebuilt sequences are computed, others are kept
+            self.sequence_hashes = pd.concat(
+                [
+                    previous_sequence_hashes.loc[kept_dataframe["sequence_id"].unique()],
+                    rebuilt_dataframe.groupby("sequence_id")["hash"].agg(combine_hashes),
+                ]
+            ).sort_index()
+            self.hash = combine_hashes(self.sequence_hashes)
+
+            # Keep predictions of images whose content did not change
+            rows = pd.Index(previous_paths).get_indexer(self.dataframe["image"].map(str).to_numpy())
+            unchanged = rows >= 0
+            unchanged[unchanged] = (
+                previous_table.hashes[rows[unchanged]] == self.image_table.hashes[unchanged]
+            )
+            self.image_table.predictions[unchanged] = previous_table.predictions[rows[unchanged]]
+
+            self.dataframe = self.get_sequence_label()
+            self.check_unique_hashes()
+        else:
+            previous_sequence_hashes = self.sequence_hashes
+        self.label_stats = label_stats
+
+        sequence_ids = set(self.sequence_hashes.index)
+        previous_sequence_ids = set(previous_sequence_hashes.index)
+        changes = {
+            "images": {
+                "added": paths[~common].tolist(),
+                "removed": previous_paths[~is_current].tolist(),
+                "modified": paths[modified].tolist(),
+            },
+            "sequences": {
+                "added": sorted(sequence_ids - previous_sequence_ids),
+                "removed": sorted(previous_sequence_ids - sequence_ids),
+                "modified": sorted(
+                    sequence_id
+                    for sequence_id in sequence_ids & previous_sequence_ids
+                    if self.sequence_hashes[sequence_id]
+                    != previous_sequence_hashes[sequence_id]
+                ),
+            },
+        }
+        logging.info(
+            f"Dataset refreshed : {len(changes['images']['added'])} images added, "
+            f"{len(changes['images']['removed'])} removed, {len(changes['images']['modified'])} modified, "
+            f"{int(relabeled.sum())} relabeled, {len(changed_prefixes)} cameras segmented again"
+        )
+
+        return changes
+
+    def determine_sequences(
+        self,
+        image_list,
+        annotations,
+        timestamps,
+        max_delta=30,
+        prefixes=None,
+        extra_columns=None,
+    ):
+        """
+        Parse images to detect files belonging to the same sequence by comparing camera name and capture dates.
+        Expects file named as *_year_month_daythour_*
+        Images are sorted by camera prefix and capture date, a new sequence starts whenever the prefix changes
+        or when more than max_delta minutes separate two consecutive captures.
+        Camera prefixes are parsed from the filenames if not provided.
+        extra_columns (dict of lists) are added to the output dataframe, ordered as the images.
+        """
+        # TODO : Date format to standardize
+        if prefixes is None:
+            prefixes, _ = parse_dates_from_filepaths(image_list)
+
+        df = pd.DataFrame(
+            {
+                "image": list(image_list),
+                "boxes": list(annotations),
+                "timestamp": pd.to_datetime(pd.Series(timestamps)).astype(
+                    "datetime64[ns]"
+                ),
+                "prefix": prefixes,
+            }
+        )
+        extra_columns = extra_columns or {}
+        for column, values in extra_columns.items():
+            df[column] = list(values)
+
+        # TODO : Better handle images without timestamps
+        has_extension = (
+            df["image"].astype(str).str.lower().str.endswith(tuple(EXTENSIONS))
+        )
+        valid = has_extension & df["timestamp"].notna()
+        for image_path in df.loc[~valid, "image"]:
+            logging.info(
+                f"Skipping {image_path} : wrong extension or unable to retrieve timestamp."
+            )
+        df = df[valid]
+
+        # Sort by prefix (in order of first appearance) then timestamp, np.lexsort is stable
+        prefix_codes = pd.factorize(df["prefix"])[0]
+        timestamps = df["timestamp"].to_numpy()
+        order = np.lexsort((timestamps, prefix_codes))
+        df = df.iloc[order].reset_index(drop=True)
+        prefix_codes = prefix_codes[order]
+        timestamps = timestamps[order]
+
+        # More than max_delta minutes between two captures or a new camera -> start a new sequence
+        new_sequence = np.ones(len(df), dtype=bool)
+        new_sequence[1:] = (prefix_codes[1:] != prefix_codes[:-1]) | (
+            np.diff(timestamps) > np.timedelta64(max_delta, "m")
+        )
+        sequence_index = np.cumsum(new_sequence) - 1
+
+        # Sequences are named after their first image
+        sequence_ids = (
+            df.loc[new_sequence, "image"]
+            .map(lambda image_path: os.path.splitext(os.path.basename(image_path))[0])
+            .to_numpy()
+        )
+        sequence_starts = timestamps[new_sequence]
+
+        return pd.DataFrame(
+            {
+                "image": df["image"],
+                "sequence_id": sequence_ids[sequence_index],
+                "boxes": df["boxes"],
+                "delta": timestamps - sequence_starts[sequence_index],
+                "timestamp": df["timestamp"],
+                **{column: df[column] for column in extra_columns},
+            }
+        )
 
     def get_sequence_label(self):
         """
         Add a column with sequence label to the existing dataframe
+        Sequence labels are also stored in self.sequence_labels, indexed by sequence_id
         """
-        self.dataframe["sequence_label"] = [""] * len(self.dataframe)
-        for sequence in self.sequences:
-            for image in sequence.images:
-                self.dataframe.loc[
-                    self.dataframe["image"] == image.path, "sequence_label"
-                ] = sequence.label
+        image_labels = self.dataframe["boxes"].map(len) > 0
+        # Sequence label indexed by sequence_id, a sequence is True if any of its images is
+        self.sequence_labels = (
+            image_labels.groupby(self.dataframe["sequence_id"])
+            .any()
+            .rename("sequence_label")
+        )
+        self.dataframe["sequence_label"] = self.dataframe["sequence_id"].map(
+            self.sequence_labels
+        )
         return self.dataframe
 
     def get_images_from_sequence(self, sequence_id):
@@ -241,21 +515,45 @@ class EvaluationDataset:
     def get_all_images(self):
         """
         Returns a list of all images in the dataset
+        The list is built once, CustomImage objects are views on the image table.
         """
-        all_images = []
-        for sequence in self.sequences:
-            all_images.extend(sequence.images)
-        return all_images
+        if self.all_images is None:
+            self.all_images = [
+                image for sequence in self.sequences for image in sequence
+            ]
+        return self.all_images
+
+    def get_image_hashes(self):
+        """
+        Returns the hash of each image of the dataframe.
+        For local datasets, hashes are stored in a cache next to the dataset so that
+        only new or modified images are read.
+        """
+        if "hash" in self.dataframe:
+            # Hugging Face images are hashed while the dataset is ingested
+            return self.dataframe["hash"]
+        if not self.is_local:
+            return [compute_file_hash(image) for image in self.dataframe["image"]]
+
+        hash_cache = ImageHashCache(os.path.join(self.datapath, HASH_CACHE_FILENAME))
+        return hash_cache.get_hashes(self.dataframe["image"], full_scan=True)
+
+    def compute_sequence_hashes(self):
+        """
+        Returns the hash of each sequence, indexed by sequence_id.
+        A sequence hash combines the hashes of its images, in the sequence order.
+        """
+        return self.dataframe.groupby("sequence_id")["hash"].agg(combine_hashes)
 
     def compute_hash(self):
         """
-        Compute datashet hash based on the concatenation of each image hash.
-        This can be used to detect dataset changes and provide identifiers
-        # TODO : add
+        Compute datashet hash as the root of a hash tree : image hashes are combined into sequence hashes,
+        stored in self.sequence_hashes, which are combined into the dataset hash.
+        This can be used to detect dataset changes and provide identifiers, a change in the dataset hash
+        can be traced back to the sequences that changed.
         """
-        hashes = [img.hash for img in self.get_all_images()]
-        combined = "".join(hashes).encode("utf-8")
-        return hashlib.sha256(combined).hexdigest()
+        self.sequence_hashes = self.compute_sequence_hashes()
+        return combine_hashes(self.sequence_hashes)
 
     def check_unique_hashes(self) -> bool:
         """
@@ -265,16 +563,11 @@ class EvaluationDataset:
         Returns:
             True if all hashes are unique, False otherwise.
         """
-        hash_to_paths = defaultdict(list)
-
-        # defaultdict(list) initialize the entry with {key : []} if key doesn't exist
-        for img in self.get_all_images():
-            hash_to_paths[img.hash].append(img.path)
-
         # Check for hash that have several path corresponding
-        self.duplicates = {
-            h: paths for h, paths in hash_to_paths.items() if len(paths) > 1
-        }
+        duplicated = self.dataframe[self.dataframe["hash"].duplicated(keep=False)]
+        self.duplicates = (
+            duplicated.groupby("hash", sort=False)["image"].apply(list).to_dict()
+        )
 
         if self.duplicates:
             logging.warning(
@@ -290,6 +583,7 @@ class EvaluationDataset:
 
     def add_sequence(self, sequence: Sequence):
         self.sequences.append(sequence)
+        self.all_images = None
 
     def dump(self, path=None):
         output_csv = (
@@ -300,18 +594,200 @@ class EvaluationDataset:
         self.dataframe.to_csv(output_csv, index=False)
         logging.info(f"DataFrame saved in {output_csv}")
 
+    def get_snapshot_path(self):
+        return os.path.join(
+            self.datapath, f"{os.path.basename(self.datapath)}.snapshot.npz"
+        )
+
+    def save_snapshot(self, path=None):
+        """
+        Saves the built dataset in a binary columnar file (numpy .npz) that can be loaded
+        back with EvaluationDataset.load_snapshot() without scanning, parsing or hashing images.
+        The path, size, modification time and inode of each source file are stored to detect a snapshot that
+        no longer matches its dataset, see get_snapshot_mismatch().
+        """
+        output_path = str(path) if path else self.get_snapshot_path()
+        source_files, source_stats = (
+            compute_source_stats(self.datapath) if self.is_local else None
+        ) or ([], np.zeros((0, 3), dtype=np.int64))
+
+        # Label lines of all images are flattened, offsets give the lines of each image
+        box_counts = self.dataframe["boxes"].map(len).to_numpy()
+        box_offsets = np.zeros(len(box_counts) + 1, dtype=np.int64)
+        np.cumsum(box_counts, out=box_offsets[1:])
+        box_lines = [line for boxes in self.dataframe["boxes"] for line in boxes]
+
+        arrays = {
+            "version": np.array(SNAPSHOT_VERSION),
+            "dataset_hash": np.array(self.hash),
+            "dataset_ID": np.array(str(self.dataset_ID)),
+            "datapath": np.array(str(self.datapath)),
+            "source_files": encode_strings(source_files),
+            "source_stats": source_stats,
+            "is_local": np.array(self.is_local),
+            "split": np.array(str(getattr(self, "split", "all"))),
+            "nb_invalid_images": np.array(getattr(self, "nb_invalid_images", 0)),
+            "image": encode_strings(self.dataframe["image"]),
+            "sequence_id": encode_strings(self.dataframe["sequence_id"]),
+            "hash": encode_strings(self.dataframe["hash"]),
+            "timestamp": self.dataframe["timestamp"].to_numpy(dtype="datetime64[ns]"),
+            "delta": self.dataframe["delta"].to_numpy(dtype="timedelta64[ns]"),
+            "box_lines": encode_strings(box_lines),
+            "box_offsets": box_offsets,
+            "box_store": self.box_store.boxes,
+            "box_store_offsets": self.box_store.offsets,
+        }
+        if "row_index" in self.dataframe:
+            # Hugging Face images are loaded back from their row in the Arrow dataset
+            arrays["row_index"] = self.dataframe["row_index"].to_numpy(dtype=np.int64)
+
+        # Write aside and rename so that an interrupted save never leaves a truncated snapshot
+        tmp_path = f"{output_path}.tmp"
+        with open(tmp_path, "wb") as fp:
+            np.savez(fp, **arrays)
+        os.replace(tmp_path, output_path)
+        logging.info(f"Dataset snapshot saved in {output_path}")
+
+    @staticmethod
+    def get_snapshot_mismatch(path, datapath):
+        """
+        Checks that a snapshot was built from the dataset at datapath and that the dataset files did not change
+        since, comparing the path, size, modification time and inode of each file.
+        Images whose stats changed are hashed (see ImageHashCache) : a snapshot stays valid if their content did not.
+        Returns the reason of the mismatch, or None if the snapshot can be used.
+        """
+        try:
+            with np.load(path, allow_pickle=False) as data:
+                version = int(data["version"])
+                if version != SNAPSHOT_VERSION:
+                    return f"snapshot version {version}, expected {SNAPSHOT_VERSION}"
+                stored_datapath = str(data["datapath"])
+                stored_files = decode_strings(data["source_files"])
+                stored_stats = data["source_stats"]
+        except (OSError, KeyError, ValueError) as e:
+            return f"unreadable snapshot : {e}"
+
+        is_local = os.path.exists(datapath)
+        if (os.path.realpath(stored_datapath) if is_local else stored_datapath) != (
+            os.path.realpath(datapath) if is_local else str(datapath)
+        ):
+            return f"snapshot built from {stored_datapath}, not {datapath}"
+        source_files, source_stats = (compute_source_stats(datapath) if is_local else None) or (
+            [],
+            np.zeros((0, 3), dtype=np.int64),
+        )
+        if source_files != stored_files:
+            nb_added = len(set(source_files) - set(stored_files))
+            nb_removed = len(set(stored_files) - set(source_files))
+            return f"dataset files changed since the snapshot : {nb_added} added, {nb_removed} removed or renamed"
+
+        changed_files = [source_files[i] for i in np.flatnonzero((source_stats != stored_stats).any(axis=1))]
+        if not changed_files:
+            return None
+        # Touched or copied images are hashed again, other files (labels, arrow files) are considered modified
+        with np.load(path, allow_pickle=False) as data:
+            stored_hashes = dict(
+                zip(
+                    [os.path.relpath(image, stored_datapath) for image in decode_strings(data["image"])],
+                    decode_strings(data["hash"]),
+                )
+            )
+        if any(filename not in stored_hashes for filename in changed_files):
+            return f"dataset files modified since the snapshot : {len(changed_files)} files changed"
+        hash_cache = ImageHashCache(os.path.join(datapath, HASH_CACHE_FILENAME))
+        hashes = hash_cache.get_hashes([os.path.join(datapath, filename) for filename in changed_files])
+        nb_modified = sum(
+            file_hash != stored_hashes[filename] for filename, file_hash in zip(changed_files, hashes)
+        )
+        if nb_modified:
+            return f"dataset files modified since the snapshot : {nb_modified} images changed"
+        return None
+
+    @classmethod
+    def load_snapshot(cls, path, datapath=None):
+        """
+        Loads a dataset saved with save_snapshot().
+        The dataset hash is recomputed from the stored image hashes and checked against the stored one.
+        If datapath is provided, the snapshot must have been built from the current files of this dataset,
+        see get_snapshot_mismatch(). A ValueError is raised otherwise.
+        """
+        if datapath is not None:
+            mismatch = cls.get_snapshot_mismatch(path, datapath)
+            if mismatch is not None:
+                raise ValueError(f"Snapshot {path} does not match dataset {datapath} : {mismatch}.")
+
+        with np.load(path, allow_pickle=False) as data:
+            arrays = {key: data[key] for key in data.files}
+
+        if int(arrays["version"]) != SNAPSHOT_VERSION:
+            raise ValueError(
+                f"Unsupported snapshot version {int(arrays['version'])} in {path}, expected {SNAPSHOT_VERSION}."
+            )
+
+        stored_hash = str(arrays["dataset_hash"])
+        dataset = cls.__new__(cls)
+        dataset.datapath = str(arrays["datapath"])
+        dataset.is_local = bool(arrays["is_local"])
+        dataset.split = str(arrays["split"])
+        dataset.nb_invalid_images = int(arrays["nb_invalid_images"])
+        dataset.label_stats = None
+        dataset.sequences = []
+        dataset.all_images = None
+        dataset.hf_images = None
+
+        images = decode_strings(arrays["image"])
+        if "row_index" in arrays:
+            # Reopening the Arrow-backed dataset only memory-maps it
+            dataset.hf_images = dataset.select_hf_images(
+                dataset.load_hugging_face_dataset(dataset.split)
+            )
+        elif dataset.is_local:
+            images = [Path(image) for image in images]
+        box_lines = decode_strings(arrays["box_lines"])
+        box_offsets = arrays["box_offsets"]
+
+        dataset.dataframe = pd.DataFrame(
+            {
+                "image": images,
+                "sequence_id": decode_strings(arrays["sequence_id"]),
+                "boxes": [
+                    box_lines[start:stop]
+                    for start, stop in zip(box_offsets[:-1], box_offsets[1:])
+                ],
+                "delta": arrays["delta"],
+                "timestamp": arrays["timestamp"],
+                "hash": decode_strings(arrays["hash"]),
+            }
+        )
+        if "row_index" in arrays:
+            dataset.dataframe.insert(
+                dataset.dataframe.columns.get_loc("hash"),
+                "row_index",
+                arrays["row_index"],
+            )
+
+        dataset.build_dataset(
+            box_store=BoxStore(arrays["box_store"], arrays["box_store_offsets"])
+        )
+        dataset.hash = dataset.compute_hash()
+        if dataset.hash != stored_hash:
+            raise ValueError(
+                f"Snapshot {path} is corrupted : dataset hash {dataset.hash} does not match {stored_hash}."
+            )
+        dataset.dataset_ID = str(arrays["dataset_ID"])
+
+        dataset.dataframe = dataset.get_sequence_label()
+        dataset.check_unique_hashes()
+        logging.info(f"Dataset loaded from snapshot {path}")
+
+        return dataset
+
     def compute_dataset_statistics(self):
         """
         Computes stastistics on the dataset built
         """
-        nb_true_sequences = 0
-        nb_true_images = 0
-        for sequence in self.sequences:
-            if sequence.label:
-                nb_true_sequences += 1
-            for image in sequence.images:
-                if image.label:
-                    nb_true_images += 1
+        nb_true_sequences = sum(sequence.label for sequence in self.sequences)
+        nb_true_images = sum(image.label for image in self.get_all_images())
         nb_images = len(self.get_all_images())
         one_img_sequences = [seq for seq in self.sequences if len(seq) == 1]
         multi_img_sequences = [len(seq) for seq in self.sequences if len(seq) > 1]
@@ -1,25 +1,151 @@
 import json
 import logging
+import multiprocessing
 import os
 import random
 from collections import deque
+from concurrent.futures import ProcessPoolExecutor, as_completed
 from datetime import datetime
+from itertools import islice
 
 import numpy as np
 import pandas as pd
 from pyroengine.engine import Engine
 from sklearn.metrics import confusion_matrix, f1_score, precision_score, recall_score
 
-from .data_structures import Sequence
+from .checkpoint_log import CheckpointLog
+from .data_structures import ImageTable, Sequence
 from .dataset import EvaluationDataset
+from .engine_replay import EngineReplay
+from .export_cache import OnnxExportCache
+from .frame_cache import FrameCache
+from .loader import ImageLoader, log_loader_stats, merge_loader_stats
+from .model import configured_onnx_sessions
+from .model_evaluation import ModelEvaluator
+from .result_buffer import ResultBuffer
 from .utils import compute_metrics, export_model, make_dict_json_compatible
 
 logging.getLogger("pyroengine.engine").setLevel(logging.WARNING)
 
+# Engine and image loader created once in each worker process of a parallel engine run
+worker_engine = None
+worker_loader = None
+
+
+def create_engine(config, model_path=None, session_params=None):
+    """
+    Creates a pyro Engine instance, the classifier session is created with the given onnxruntime options
+    Returns the engine and the description of its onnxruntime session
+    """
+    with configured_onnx_sessions(session_params) as session_descriptions:
+        engine = Engine(
+            nb_consecutive_frames=config["nb_consecutive_frames"],
+            conf_thresh=config["conf_thresh"],
+            max_bbox_size=config["max_bbox_size"],
+            model_path=model_path,
+        )
+    session_description = session_descriptions[-1] if session_descriptions else None
+    return engine, session_description
+
+
+def predict_sequence(engine: Engine, loaded_images, nb_images: int):
+    """
+    Runs the engine on the next nb_images (image, pil_image) pairs of loaded_images, the images of a sequence.
+    Returns an array with the confidence predicted for each image, the engine is reset for the next sequence.
+    """
+    confidences = np.empty(nb_images, dtype=np.float64)
+    for i, (image, pil_image) in enumerate(islice(loaded_images, nb_images)):
+        # Run prediction on a single image
+        confidences[i] = engine.predict(pil_image)
+
+    # Clear states to reset the engine for the next sequence
+    engine._states = {
+        "-1": {
+            "last_predictions": deque([], engine.nb_consecutive_frames),
+            "ongoing": False,
+        },
+    }
+    return confidences
+
+
+def init_engine_worker(
+    config,
+    model_path,
+    session_params,
+    num_threads,
+    input_size=None,
+    loader_workers=4,
+    prefetch=8,
+    frame_cache_dir=None,
+    frame_cache_size=None,
+):
+    """
+    Initializes a worker process : limits the number of intra-op threads, creates the engine and the image loader
+    used for all sequences of the worker, with its threads and frame cache
+    """
+    global worker_engine, worker_loader
+    os.environ["OMP_NUM_THREADS"] = str(num_threads)
+    session_params = dict(session_params or {})
+    session_params.setdefault("intra_op_num_threads", num_threads)
+    worker_engine, _ = create_engine(config, model_path, session_params)
+    worker_loader = ImageLoader(
+        num_workers=loader_workers,
+        prefetch=prefetch,
+        target_size=input_size,
+        frame_cache=FrameCache(frame_cache_dir, max_size=frame_cache_size) if frame_cache_dir else None,
+    )
+
+
+def run_sequence_task(index, sequence: Sequence):
+    """
+    Runs the engine of the worker process on a sequence
+    Returns the index of the sequence, the confidence of each image and the loader statistics
+    """
+    loaded_images = worker_loader.load(sequence.images)
+    try:
+        confidences = predict_sequence(worker_engine, loaded_images, len(sequence))
+    finally:
+        loaded_images.close()
+    return index, confidences, worker_loader.get_stats()
+
+
+def aggregate_sequences(predictions_df: pd.DataFrame):
+    """
+    Aggregates image results by sequence in a single pass over integer sequence codes.
+    Returns NumPy arrays, sorted by sequence_id : sequence ids, labels (label of the first image of the sequence),
+    whether the engine raised a detection and the timedelta of the first detection (NaT if none).
+    """
+    codes, sequence_ids = pd.factorize(predictions_df["sequence_id"], sort=True)
+    sequence_ids = np.asarray(sequence_ids, dtype=object)
+    nb_sequences = len(sequence_ids)
+    rows = np.arange(len(codes))
+
+    first_rows = np.full(nb_sequences, len(codes))
+    np.minimum.at(first_rows, codes, rows)
+    labels = predictions_df["sequence_label"].to_numpy(dtype=bool)[first_rows]
+
+    predictions = predictions_df["prediction"].to_numpy(dtype=bool)
+    has_detection = np.bincount(codes[predictions], minlength=nb_sequences) > 0
+
+    # NaT is the smallest int64 : unknown timedeltas are replaced by the largest value not to be selected
+    no_delay = np.iinfo(np.int64).max
+    timedeltas = pd.to_timedelta(predictions_df["timedelta"], errors="coerce").to_numpy(
+        dtype="timedelta64[ns]"
+    ).view(np.int64)
+    timedeltas = np.where(timedeltas == np.iinfo(np.int64).min, no_delay, timedeltas)
+    delays = np.full(nb_sequences, no_delay, dtype=np.int64)
+    np.minimum.at(delays, codes[predictions], timedeltas[predictions])
+    detection_delays = np.where(delays == no_delay, np.iinfo(np.int64).min, delays).view(
+        "timedelta64[ns]"
+    )
+
+    return sequence_ids, labels, has_detection, detection_delays
+
 
 class EngineEvaluator:
     # TODO : as EngineEvaluator and ModelEvaluator share some attributes and methods the should inherits from an EvaluatorClass
     # that manages instanciation, saving, run_id etc.
+
     def __init__(
         self,
         dataset: EvaluationDataset,
@@ -36,21 +162,50 @@ class EngineEvaluator:
         )
         self.run_id = run_id if run_id else self.generate_run_id()
         self.resume = resume  # If True, we look for partial results in results/<run_id>
-        self.results_data = [
-            "sequence_id",
-            "image",
-            "sequence_label",
-            "ground_truth_boxes",
-            "image_label",
-            "prediction",
-            "confidence",
-            "timedelta",
-        ]
+        # If True, the engine is replayed from cached per-frame predictions instead of running the model
+        self.use_replay = self.config.get("replay", False)
+        self.results_data = list(ResultBuffer.COLUMNS)
         self.predictions_csv = ""
+        self.checkpoint_log = None
         self.model_path = self.config.get("model_path", None)
         self.needs_deletion = False
         self.run_model_path = None
+        # Images are decoded ahead of the engine by an ImageLoader
+        self.loader_workers = self.config.get("loader_workers", 4)
+        self.prefetch = self.config.get("prefetch", 8)
+        # Decoded frames can be cached on disk and shared between models and runs
+        self.frame_cache_dir = self.config.get("frame_cache")
+        self.frame_cache_size = self.config.get("frame_cache_size", 10 * 1024**3)
+        self.frame_cache = (
+            FrameCache(self.frame_cache_dir, max_size=self.frame_cache_size) if self.frame_cache_dir else None
+        )
+        self.loader_stats = None
+        # Sequences are processed in num_workers processes if num_workers > 1
+        self.num_workers = self.config.get("num_workers", 1)
+        self.threads_per_worker = self.config.get("threads_per_worker")
+        # onnxruntime session options of the engine classifier, see create_onnx_session
+        self.session_params = self.config.get("session_params", {})
+        self.session_description = None
+        # Model, threshold and frame size of the replayed detections, recorded with the metrics
+        self.replay_description = None
+        # The engine is also created for replays, its classifier gives the default replay threshold
         self.engine = self.instanciate_engine()
+        self.replay = None
+        if self.use_replay:
+            # Detections are replayed at the threshold of the engine classifier, unless model_conf_thresh is set
+            model_conf_thresh = self.config.get("model_conf_thresh")
+            if model_conf_thresh is None:
+                model_conf_thresh = self.engine.model.conf
+            self.replay = EngineReplay(
+                nb_consecutive_frames=self.config["nb_consecutive_frames"],
+                conf_thresh=self.config["conf_thresh"],
+                max_bbox_size=self.config["max_bbox_size"],
+                model_conf_thresh=model_conf_thresh,
+            )
+        # Images are decoded at the size of the engine classifier input
+        self.input_size = self.config.get("imgsz") or getattr(
+            getattr(self.engine, "model", None), "imgsz", None
+        )
 
     def instanciate_engine(self):
         """
@@ -61,57 +216,159 @@ class EngineEvaluator:
             if self.model_path.endswith(".onnx"):
                 self.run_model_path = self.model_path
             elif self.model_path.endswith(".pt"):
-                logging.info(f"Exporting model file from pt to onnx format.")
-                self.run_model_path = export_model(self.model_path)
-                self.needs_deletion = True  # We remove the local .onnx file created
+                # Onnx exports are cached and reused across runs, unless export_cache is set to None
+                export_args = {"dynamic": True}
+                if self.config.get("simplify") is not None:
+                    export_args["simplify"] = self.config["simplify"]  # Slim the graph with onnxslim
+                export_cache_dir = self.config.get("export_cache", "data/export_cache")
+                if export_cache_dir:
+                    export_cache = OnnxExportCache(
+                        export_cache_dir,
+                        max_size=self.config.get("export_cache_size", 5 * 1024**3),
+                    )
+                    self.run_model_path = export_cache.get_onnx_path(self.model_path, **export_args)
+                else:
+                    logging.info(f"Exporting model file from pt to onnx format.")
+                    self.run_model_path = export_model(self.model_path, **export_args)
+                    self.needs_deletion = True  # We remove the local .onnx file created
             else:
                 raise RuntimeError(
                     f"Model format not supported by the Engine : {self.model_path}"
                 )
 
-        engine = Engine(
-            nb_consecutive_frames=self.config["nb_consecutive_frames"],
-            conf_thresh=self.config["conf_thresh"],
-            max_bbox_size=self.config["max_bbox_size"],
-            model_path=self.run_model_path,
+        engine, self.session_description = create_engine(
+            self.config, self.run_model_path, self.session_params
         )
-
         return engine
 
-    def run_engine_sequence(self, sequence: Sequence):
+    def run_engine_sequence(self, sequence: Sequence, loaded_images=None):
         """
         Instanciate an Engine and run predictions on a Sequence containing a list of images.
-        Returns a dataframe containing image info and the confidence predicted
+        loaded_images is an iterator over (image, pil_image) pairs, as yielded by an ImageLoader, positioned
+        on the first image of the sequence. If not provided, images of the sequence are loaded here.
+        Returns an array with the confidence predicted for each image of the sequence
         """
 
         # Initialize a new Engine for each sequence
         # TODO : better handle default values
 
-        sequence_results = pd.DataFrame(columns=self.results_data)
-
-        for image in sequence.images:
-            pil_image = image.load()
-            # Run prediction on a single image
-            confidence = self.engine.predict(pil_image)
-            sequence_results.loc[len(sequence_results)] = [
-                sequence.sequence_id,  # sequence_id
-                image.path,  # image
-                sequence.label,  # sequence_label
-                image.boxes,  # ground_truth_boxes
-                image.label,  # image_label
-                bool(confidence > self.engine.conf_thresh),  # prediction (True/False)
-                confidence,  # confidence
-                image.timedelta,  # timedelta
-            ]
+        if loaded_images is None:
+            loaded_images = iter(
+                ImageLoader(
+                    sequence.images,
+                    num_workers=self.loader_workers,
+                    prefetch=self.prefetch,
+                    target_size=self.input_size,
+                    frame_cache=self.frame_cache,
+                )
+            )
 
-        # Clear states to reset the engine for the next sequence
-        self.engine._states = {
-            "-1": {
-                "last_predictions": deque([], self.config["nb_consecutive_frames"]),
-                "ongoing": False,
+        return predict_sequence(self.engine, loaded_images, len(sequence))
+
+    def load_raw_predictions(self):
+        """
+        Retrieves the raw detections of each image of the dataset, needed to replay the engine.
+        Detections are computed as by the engine : with the onnx model it runs (the export of .pt models), through
+        the pyroengine Classifier pre-processing and post-processing, one frame at a time. They are always read from
+        the prediction store at the replay threshold, or computed once and saved there (see
+        ModelEvaluator.load_predictions) : predictions already set on images may come from another model or
+        confidence threshold.
+        """
+        inference_params = {
+            **self.config.get("inference_params", {}),
+            "conf": self.replay.model_conf_thresh,
+        }
+        model_evaluator = ModelEvaluator(
+            dataset=self.dataset,
+            config={
+                **self.config,
+                "model_path": self.run_model_path,
+                "inference_params": inference_params,
+                # The engine runs its classifier on each frame alone
+                "batch_size": 1,
+                # Detections must be computed at the replay threshold, not at the floor confidence of pr_curve
+                "pr_curve": False,
             },
+            use_existing_predictions=True,
+        )
+        model_evaluator.load_predictions()
+        self.loader_stats = model_evaluator.loader_stats
+
+        # Detections only match the engine inputs if frames are decoded at the same size
+        input_size = model_evaluator.model.get_input_size()
+        if self.input_size is not None and input_size != self.input_size:
+            logging.warning(
+                f"Replayed detections are computed on frames decoded at {input_size}, the engine decodes them at "
+                f"{self.input_size} : replay and engine results may differ"
+            )
+        self.replay_description = {
+            "model_path": self.run_model_path,
+            "model_conf_thresh": self.replay.model_conf_thresh,
+            "input_size": input_size,
+            "engine_input_size": self.input_size,
         }
-        return sequence_results
+
+    def replay_engine_sequence(self, sequence: Sequence):
+        """
+        Replays the engine on a sequence from the raw detections of its images.
+        Returns an array with the confidence of each image, as run_engine_sequence.
+        """
+        return self.replay.replay_sequence([image.prediction for image in sequence.images])
+
+    def run_parallel_engine(self, sequences):
+        """
+        Runs the engine in num_workers processes that each create their own Engine. Sequences are independent as
+        the engine is reset after each of them, they are sent whole to workers, gathered in compact ImageTable
+        objects. Longest sequences are submitted first so that a long sequence does not end the run alone.
+        Yields (index, confidences) pairs as sequences complete.
+        """
+        num_threads = self.threads_per_worker or max(1, (os.cpu_count() or 1) // self.num_workers)
+        logging.info(
+            f"Running the engine in {self.num_workers} processes with {num_threads} threads each"
+        )
+
+        # sorted is stable, sequences of the same length keep the dataset order
+        order = sorted(range(len(sequences)), key=lambda index: len(sequences[index]), reverse=True)
+        loader_stats = []
+        with ProcessPoolExecutor(
+            max_workers=self.num_workers,
+            # Processes are spawned, forking a process that already runs onnxruntime is not safe
+            mp_context=multiprocessing.get_context("spawn"),
+            initializer=init_engine_worker,
+            initargs=(
+                self.config,
+                self.run_model_path,
+                self.session_params,
+                num_threads,
+                self.input_size,
+                self.loader_workers,
+                self.prefetch,
+                self.frame_cache_dir,
+                self.frame_cache_size,
+            ),
+        ) as executor:
+            futures = [
+                executor.submit(
+                    run_sequence_task,
+                    index,
+                    Sequence(
+                        sequences[index].sequence_id,
+                        table=ImageTable.from_images(sequences[index].images),
+                    ),
+                )
+                for index in order
+            ]
+            try:
+                for future in as_completed(futures):
+                    index, confidences, stats = future.result()
+                    loader_stats.append(stats)
+                    yield index, confidences
+            finally:
+                # Pending sequences are not run if the run is interrupted
+                for future in futures:
+                    future.cancel()
+
+        self.loader_stats = merge_loader_stats(loader_stats)
 
     def run_engine_dataset(self):
         """
@@ -125,31 +382,83 @@ class EngineEvaluator:
             )
             os.makedirs(self.result_dir, exist_ok=True)
             self.predictions_csv = os.path.join(self.result_dir, "results.csv")
+            # The results of each sequence are appended to the log as soon as the sequence is processed
+            self.checkpoint_log = CheckpointLog(
+                os.path.join(self.result_dir, "checkpoint.jsonl"), dtypes=ResultBuffer.COLUMNS
+            )
 
-        # Previous predictions are loaded if they exist and if resume is set to True
-        # FIXME : this doesn't work predictions are re-run every time
-        if os.path.isfile(self.predictions_csv) and self.resume:
-            logging.info(f"Loading previous predictions in {self.predictions_csv}")
-            self.predictions_df = pd.read_csv(self.predictions_csv)
-        else:
-            self.predictions_df = pd.DataFrame(columns=self.results_data)
+        # Results of previous runs with the same run_id are loaded if resume is set to True
+        previous_results = None
+        done_sequences = set()
+        if self.checkpoint_log is not None:
+            if self.resume:
+                done_sequences, previous_results = self.checkpoint_log.load()
+                if previous_results is not None:
+                    logging.info(
+                        f"Loaded results of {len(done_sequences)} sequences from {self.checkpoint_log.path}"
+                    )
+            elif os.path.isfile(self.checkpoint_log.path):
+                os.remove(self.checkpoint_log.path)
 
         try:
-            for sequence in self.dataset:
-                if self.resume and sequence.sequence_id in set(
-                    self.predictions_df["sequence_id"].to_list()
-                ):
-                    logging.info(
-                        f"Results of {sequence} found in predictions csv, sequence skipped."
+            sequences = [
+                sequence for sequence in self.dataset if sequence.sequence_id not in done_sequences
+            ]
+            if done_sequences:
+                logging.info(
+                    f"Results of {len(self.dataset.sequences) - len(sequences)} sequences found in the checkpoint log, "
+                    f"{len(sequences)} sequences left."
+                )
+
+            loader = None
+            if self.use_replay:
+                # The engine is replayed from the raw detections of each frame, the model is run at most once
+                self.load_raw_predictions()
+                conf_thresh = self.replay.conf_thresh
+                all_sequence_confidences = (
+                    (index, self.replay_engine_sequence(sequence))
+                    for index, sequence in enumerate(sequences)
+                )
+            elif self.num_workers > 1 and len(sequences) > 1:
+                conf_thresh = self.engine.conf_thresh
+                all_sequence_confidences = self.run_parallel_engine(sequences)
+            else:
+                # A single loader is used for all sequences so that images of the next sequence are decoded
+                # while the engine processes the end of the current one. Images are yielded in sequence order.
+                loader = ImageLoader(
+                    (image for sequence in sequences for image in sequence),
+                    num_workers=self.loader_workers,
+                    prefetch=self.prefetch,
+                    target_size=self.input_size,
+                    frame_cache=self.frame_cache,
+                )
+                loaded_images = iter(loader)
+                conf_thresh = self.engine.conf_thresh
+                all_sequence_confidences = (
+                    (index, self.run_engine_sequence(sequence, loaded_images))
+                    for index, sequence in enumerate(sequences)
+                )
+
+            # Sequences may complete in any order, they are logged as soon as they complete
+            sequence_confidences = [None] * len(sequences)
+            for index, confidences in all_sequence_confidences:
+                sequence_confidences[index] = confidences
+                if self.checkpoint_log is not None:
+                    sequence_results = ResultBuffer(len(confidences))
+                    sequence_results.add_sequence(sequences[index], confidences, conf_thresh)
+                    self.checkpoint_log.append(
+                        sequences[index].sequence_id, sequence_results.get_columns()
                     )
-                    continue
-                sequence_results = self.run_engine_sequence(sequence)
 
-                # Add sequence results to result dataframe
-                self.predictions_df = pd.concat([self.predictions_df, sequence_results])
-                # Checkpoint to save predictions every 50 images
-                if self.save and len(self.predictions_df) % 50 == 0:
-                    self.predictions_df.to_csv(self.predictions_csv, index=False)
+            # Results are stored in typed columns in dataset order, the dataframe is built once at the end
+            results = ResultBuffer(sum(len(sequence) for sequence in sequences))
+            for sequence, confidences in zip(sequences, sequence_confidences):
+                results.add_sequence(sequence, confidences, conf_thresh)
+
+            if loader is not None:
+                self.loader_stats = loader.get_stats()
+            if not self.use_replay and self.loader_stats is not None:
+                log_loader_stats(self.loader_stats)
 
         finally:
             if self.needs_deletion:
@@ -160,9 +469,17 @@ class EngineEvaluator:
                         f"Temporary model file could not be removed : {self.run_model_path}"
                     )
 
+        self.predictions_df = results.to_dataframe()
+        if previous_results is not None:
+            self.predictions_df = pd.concat(
+                [previous_results, self.predictions_df], ignore_index=True
+            )
+
         if self.save:
             logging.info(f"Saving predictions in {self.predictions_csv}")
-            self.predictions_df.to_csv(self.predictions_csv, index=False)
+            tmp_path = f"{self.predictions_csv}.tmp"
+            self.predictions_df.to_csv(tmp_path, index=False)
+            os.replace(tmp_path, self.predictions_csv)
 
     def compute_image_level_metrics(self):
         """
@@ -199,69 +516,39 @@ class EngineEvaluator:
         """
         Computes sequence-based metrics from the prediction dataframe
         """
-        sequence_metrics = []
-
-        for sequence_id, group in self.predictions_df.groupby("sequence_id"):
-            sequence_label = group["sequence_label"].iloc[0]
-            has_detection = group["prediction"].any()
-            detection_timedeltas = group[group["prediction"]]["timedelta"]
-            detection_timedeltas = pd.to_timedelta(
-                detection_timedeltas, errors="coerce"
-            )
-            detection_delay = (
-                detection_timedeltas.min() if not detection_timedeltas.empty else None
-            )
-
-            if not detection_timedeltas.empty:
-                detection_delay = np.min(detection_timedeltas)
-            else:
-                detection_delay = None
-
-            sequence_metrics.append(
-                {
-                    "sequence_id": sequence_id,
-                    "label": sequence_label,
-                    "has_detection": has_detection,
-                    "detection_delay": detection_delay,
-                }
-            )
+        sequence_ids, labels, has_detection, detection_delays = aggregate_sequences(
+            self.predictions_df
+        )
 
-        sequence_df = pd.DataFrame(sequence_metrics)
-
-        tp_sequences = sequence_df[
-            (sequence_df["label"] == True) & (sequence_df["has_detection"] == True)
-        ]
-        fn_sequences = sequence_df[
-            (sequence_df["label"] == True) & (sequence_df["has_detection"] == False)
-        ]
-        fp_sequences = sequence_df[
-            (sequence_df["label"] == False) & (sequence_df["has_detection"] == True)
-        ]
-        tn_sequences = sequence_df[
-            (sequence_df["label"] == False) & (sequence_df["has_detection"] == False)
-        ]
+        tp_mask = labels & has_detection
+        fn_mask = labels & ~has_detection
+        fp_mask = ~labels & has_detection
+        tn_mask = ~labels & ~has_detection
+        nb_tp, nb_fn, nb_fp, nb_tn = (
+            int(np.count_nonzero(mask)) for mask in (tp_mask, fn_mask, fp_mask, tn_mask)
+        )
         metrics = compute_metrics(
-            false_positives=len(fp_sequences),
-            true_positives=len(tp_sequences),
-            false_negatives=len(fn_sequences),
+            false_positives=nb_fp,
+            true_positives=nb_tp,
+            false_negatives=nb_fn,
         )
 
         predictions = {
-            "tp": tp_sequences["sequence_id"].to_list(),
-            "fn": fn_sequences["sequence_id"].to_list(),
-            "fp": fp_sequences["sequence_id"].to_list(),
-            "tn": tn_sequences["sequence_id"].to_list(),
+            "tp": sequence_ids[tp_mask].tolist(),
+            "fn": sequence_ids[fn_mask].tolist(),
+            "fp": sequence_ids[fp_mask].tolist(),
+            "tn": sequence_ids[tn_mask].tolist(),
         }
         logging.info("Sequence-level metrics")
         logging.info(
             f"Precision: {metrics['precision']:.3f}, Recall: {metrics['recall']:.3f}, F1: {metrics['f1']:.3f}"
         )
-        logging.info(
-            f"TP: {len(tp_sequences)}, FP: {len(fp_sequences)}, FN: {len(fn_sequences)}, TN: {len(tn_sequences)}"
-        )
+        logging.info(f"TP: {nb_tp}, FP: {nb_fp}, FN: {nb_fn}, TN: {nb_tn}")
 
-        if not tp_sequences["detection_delay"].isnull().all():
-            avg_detection_delay = tp_sequences["detection_delay"].dropna().mean()
+        # Delays of TP sequences, NaT if the timedelta of the first detection is unknown
+        tp_delays = pd.to_timedelta(detection_delays[tp_mask])
+        avg_detection_delay = tp_delays.dropna().mean() if tp_delays.notna().any() else None
+        if avg_detection_delay is not None:
             logging.info(
                 f"Avg. delay before detection (TP sequences): {avg_detection_delay}"
             )
@@ -272,15 +559,11 @@ class EngineEvaluator:
             "precision": metrics["precision"],
             "recall": metrics["recall"],
             "f1": metrics["f1"],
-            "tp": len(tp_sequences),
-            "fp": len(fp_sequences),
-            "fn": len(fn_sequences),
-            "tn": len(tn_sequences),
-            "avg_detection_delay": (
-                avg_detection_delay
-                if not tp_sequences["detection_delay"].isnull().all()
-                else None
-            ),
+            "tp": nb_tp,
+            "fp": nb_fp,
+            "fn": nb_fn,
+            "tn": nb_tn,
+            "avg_detection_delay": avg_detection_delay,
             "predictions": predictions,
         }
 
@@ -292,8 +575,13 @@ class EngineEvaluator:
         # Compute metrics from predictions
         self.metrics = {
             "run_id": self.run_id,
+            # Whether the pyroengine Engine was run or replayed from cached detections
+            "mode": "replay" if self.use_replay else "engine",
+            "replay": self.replay_description,
             "image_metrics": self.compute_image_level_metrics(),
             "sequence_metrics": self.compute_sequence_level_metrics(),
+            "loader": self.loader_stats,
+            "session": self.session_description,
         }
 
         # Save metrics in a json file
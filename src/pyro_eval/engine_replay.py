@@ -0,0 +1,100 @@
+from collections import deque
+from typing import List
+
+import numpy as np
+
+from .utils import box_iou
+
+
+def nms(boxes: np.ndarray, overlap_thresh: float = 0) -> np.ndarray:
+    """
+    Non maximum suppression as done in the pyroengine : boxes are visited by increasing confidence and a box
+    is removed if it overlaps any box that is still kept.
+    """
+    boxes = boxes[boxes[:, -1].argsort()]
+    if len(boxes) == 0:
+        return boxes
+
+    indices = np.arange(len(boxes))
+    ious = box_iou(boxes[:, :4], boxes[:, :4])
+    for i in range(len(boxes)):
+        other_indices = indices[indices != i]
+        if np.any(ious[i, other_indices] > overlap_thresh):
+            indices = other_indices
+
+    return boxes[indices]
+
+
+class EngineReplay:
+    """
+    Reproduces the decisions of the pyroengine Engine from raw per-frame detections, without running the model.
+    Detections ([[x1, y1, x2, y2, confidence]] with xyxyn boxes) must have been predicted with a confidence
+    threshold at most model_conf_thresh. They are filtered like the Engine classifier output (confidence and
+    max_bbox_size) and aggregated over consecutive frames like Engine._update_states.
+    As the replay is cheap, several engine configurations can be evaluated from a single inference pass.
+    """
+
+    def __init__(
+        self,
+        nb_consecutive_frames: int = 4,
+        conf_thresh: float = 0.15,
+        max_bbox_size: float = 0.4,
+        model_conf_thresh: float = 0.05,
+    ):
+        self.nb_consecutive_frames = nb_consecutive_frames
+        self.conf_thresh = conf_thresh
+        self.max_bbox_size = max_bbox_size
+        self.model_conf_thresh = model_conf_thresh
+        self.reset()
+
+    def reset(self):
+        """
+        Clears the engine states, before a new sequence
+        """
+        self.last_predictions = deque([], self.nb_consecutive_frames)
+
+    def filter_predictions(self, prediction) -> np.ndarray:
+        """
+        Applies the Engine classifier filters to raw detections
+        """
+        preds = np.asarray(prediction, dtype=np.float64).reshape(-1, 5)
+        preds = preds[preds[:, 4] > self.model_conf_thresh]
+        preds = np.clip(preds, 0, 1)
+        return preds[(preds[:, 2] - preds[:, 0]) < self.max_bbox_size]
+
+    def update_states(self, preds: np.ndarray) -> float:
+        """
+        Aggregates the detections of the frame with those of the previous frames and returns the frame confidence.
+        The Engine also lowers its alert threshold while an alert is ongoing, but only uses it to select the boxes
+        of the alert : it does not change the returned confidence, and is not reproduced.
+        """
+        boxes = np.concatenate([preds, *self.last_predictions]).reshape(-1, 5)
+
+        conf = 0.0
+        if len(boxes):
+            best_boxes = nms(boxes)
+            # We keep only detections with at least two boxes above conf_thresh
+            detections = boxes[boxes[:, -1] > self.conf_thresh, :]
+            ious_detections = box_iou(best_boxes[:, :4], detections[:, :4])
+            strong_detection = np.sum(ious_detections > 0, 0) > 1
+            best_boxes = best_boxes[strong_detection, :]
+            if len(best_boxes):
+                ious = box_iou(best_boxes[:, :4], boxes[:, :4])
+                best_boxes_scores = np.array([boxes[iou > 0, 4].sum() for iou in ious.T])
+                conf = float(np.max(best_boxes_scores) / (self.nb_consecutive_frames + 1))  # memory + preds
+
+        self.last_predictions.append(preds)
+        return conf
+
+    def predict(self, prediction) -> float:
+        """
+        Returns the confidence the Engine would return for a frame, from its raw detections
+        """
+        return self.update_states(self.filter_predictions(prediction))
+
+    def replay_sequence(self, predictions: List) -> np.ndarray:
+        """
+        Returns the confidence of each frame of a sequence, from the raw detections of its frames in order
+        """
+        self.reset()
+        return np.array([self.predict(prediction) for prediction in predictions], dtype=np.float64)
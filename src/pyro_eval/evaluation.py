@@ -51,8 +51,9 @@ class EvaluationPipeline:
                 dataset=self.engine_dataset,
                 config=self.config["model"],
                 run_id=self.run_id,
+                # Engine results are checkpointed so that the run can be resumed with the same run_id
+                save=resume,
                 resume=resume,
-                use_existing_predictions=use_existing_predictions
             )
 
     def get_config(self, config):
@@ -68,6 +69,8 @@ class EvaluationPipeline:
         engine_config.setdefault("nb_consecutive_frames", dummy_engine.nb_consecutive_frames)
         engine_config.setdefault("conf_thresh", dummy_engine.conf_thresh)
         engine_config.setdefault("max_bbox_size", dummy_model.max_bbox_size)
+        # The engine is run on each frame unless replay is explicitly enabled, see EngineReplay
+        engine_config.setdefault("replay", False)
 
         model_config = config.get("model", {})
         model_config.setdefault("model_path", config.get("model_path"))
@@ -0,0 +1,108 @@
+import hashlib
+import json
+import logging
+import os
+import shutil
+from importlib.metadata import PackageNotFoundError, version
+
+from .utils import compute_file_hash, export_model, file_lock
+
+
+class OnnxExportCache:
+    """
+    Content-addressed cache of onnx exports of .pt models, shared across runs and processes.
+    Exports are keyed by the hash of the .pt file, the export arguments and the versions of the packages
+    involved in the export, so that a checkpoint is only exported once for a given configuration.
+    Least recently used exports are evicted when the cache grows above max_size bytes.
+    """
+
+    # Packages whose version changes the exported graph
+    EXPORT_PACKAGES = ["ultralytics", "onnx", "onnxslim", "torch"]
+
+    def __init__(self, cache_dir, max_size=5 * 1024**3):
+        self.cache_dir = str(cache_dir)
+        self.max_size = max_size
+        os.makedirs(self.cache_dir, exist_ok=True)
+        self.lock_path = os.path.join(self.cache_dir, "cache.lock")
+
+    @classmethod
+    def get_package_versions(cls):
+        versions = {}
+        for package in cls.EXPORT_PACKAGES:
+            try:
+                versions[package] = version(package)
+            except PackageNotFoundError:
+                versions[package] = None
+        return versions
+
+    def get_key(self, model_path, export_args):
+        description = {
+            "model_hash": compute_file_hash(model_path),
+            "export_args": export_args,
+            "versions": self.get_package_versions(),
+        }
+        return hashlib.sha256(
+            json.dumps(description, sort_keys=True).encode()
+        ).hexdigest()
+
+    def get_onnx_path(self, model_path, **export_args):
+        """
+        Returns the path of the onnx export of a .pt model, the model is exported if it is not in the cache yet
+        """
+        key = self.get_key(model_path, export_args)
+        onnx_path = os.path.join(self.cache_dir, f"{key}.onnx")
+
+        # One lock per key : a model exported by another process is waited for, other models are not blocked
+        with file_lock(os.path.join(self.cache_dir, f"{key}.lock")):
+            if os.path.isfile(onnx_path):
+                logging.info(f"Onnx export of {model_path} found in cache : {onnx_path}")
+                # Access time used for eviction
+                os.utime(onnx_path)
+                return onnx_path
+
+            logging.info(f"Exporting {model_path} from pt to onnx format.")
+            # ultralytics writes the export next to the .pt file : the model is exported from a link in a temporary
+            # directory of the key, so that nothing is written next to the original file, and the export is moved
+            # in the cache once complete
+            tmp_dir = os.path.join(self.cache_dir, f"{key}.tmp")
+            shutil.rmtree(tmp_dir, ignore_errors=True)  # Left by an interrupted export
+            os.makedirs(tmp_dir)
+            try:
+                tmp_model_path = os.path.join(tmp_dir, os.path.basename(model_path))
+                try:
+                    os.link(model_path, tmp_model_path)
+                except OSError:
+                    # Hard links are not supported across file systems
+                    shutil.copyfile(model_path, tmp_model_path)
+                exported_path = export_model(tmp_model_path, **export_args)
+                os.replace(exported_path, onnx_path)
+            finally:
+                shutil.rmtree(tmp_dir, ignore_errors=True)
+
+        self.evict(keep=onnx_path)
+        return onnx_path
+
+    def evict(self, keep=None):
+        """
+        Removes least recently used exports until the cache size is below max_size
+        """
+        with file_lock(self.lock_path):
+            exports = []
+            for filename in os.listdir(self.cache_dir):
+                path = os.path.join(self.cache_dir, filename)
+                if filename.endswith(".onnx") and path != keep:
+                    stat = os.stat(path)
+                    exports.append((stat.st_mtime, stat.st_size, path))
+            total_size = sum(size for _, size, _ in exports)
+            if keep is not None and os.path.isfile(keep):
+                total_size += os.path.getsize(keep)
+
+            for _, size, path in sorted(exports):
+                if total_size <= self.max_size:
+                    break
+                logging.info(f"Removing onnx export from cache : {path}")
+                try:
+                    os.remove(path)
+                    total_size -= size
+                except OSError as e:
+                    logging.warning(f"Unable to remove {path} from the export cache : {e}")
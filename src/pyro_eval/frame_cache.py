@@ -0,0 +1,235 @@
+import json
+import logging
+import os
+import threading
+import time
+
+import numpy as np
+
+from .utils import file_lock
+
+
+class FrameCache:
+    """
+    Content-addressed cache of decoded frames, shared across models and runs.
+    Frames are stored as raw uint8 RGB arrays appended to segment files, which are memory-mapped to read frames as
+    zero-copy views. An index maps each key (image hash, decoding size) to [segment, offset, height, width].
+    The index is an append-only json lines file : new entries are appended, the last entry of a key is used. Its
+    first line holds a generation id, changed when the index is rewritten without the entries of evicted segments.
+    The cache size is bounded by max_size bytes : when a segment is full a new one is started, and the oldest
+    segments are evicted while the cache is above max_size.
+    Several processes can share a cache : appends, index updates and evictions are serialized with a file lock.
+    """
+
+    # Number of new frames after which the index is written to disk
+    INDEX_FLUSH_INTERVAL = 256
+    # The budget is split in segments, the oldest segment is evicted as a whole
+    NB_SEGMENTS = 8
+
+    def __init__(self, cache_dir, max_size=10 * 1024**3):
+        self.cache_dir = str(cache_dir)
+        os.makedirs(self.cache_dir, exist_ok=True)
+        self.max_size = max_size
+        self.segment_size = max(1, max_size // self.NB_SEGMENTS)
+        self.index_path = os.path.join(self.cache_dir, "index.jsonl")
+        self.lock_path = os.path.join(self.cache_dir, "cache.lock")
+
+        # Frames are read and written from the threads of an ImageLoader
+        self.lock = threading.Lock()
+        self.index = {}
+        self.index_position = 0  # Size of the index file already read
+        self.index_header = None  # Generation line of the index file read, see write_index_file
+        self.pending = {}  # Entries not yet written in the index file
+        self.buffers = {}  # Memory maps of the segments, remapped when they grow
+        self.hits = 0
+        self.misses = 0
+        with self.lock, file_lock(self.lock_path):
+            self.remove_legacy_files()
+            self.read_index()
+
+    @staticmethod
+    def get_key(image_hash, target_size):
+        if target_size is None:
+            size = "full"
+        elif isinstance(target_size, (int, float)):
+            size = str(int(target_size))
+        else:
+            size = "x".join(str(int(value)) for value in target_size)
+        return f"{image_hash}_{size}"
+
+    def get_segment_path(self, segment):
+        return os.path.join(self.cache_dir, f"{segment}.bin")
+
+    def list_segments(self):
+        """
+        Returns segment names, from the oldest to the most recent
+        """
+        return sorted(
+            filename[: -len(".bin")]
+            for filename in os.listdir(self.cache_dir)
+            if filename.startswith("frames-") and filename.endswith(".bin")
+        )
+
+    def remove_legacy_files(self):
+        """
+        Removes the single blob and json index of caches created before segments
+        """
+        for filename in ["frames.bin", "index.json"]:
+            path = os.path.join(self.cache_dir, filename)
+            if os.path.isfile(path):
+                logging.info(f"Removing legacy frame cache file {path}")
+                os.remove(path)
+
+    def read_index(self):
+        """
+        Reads the entries appended to the index file since the last read, or the whole index if it was replaced.
+        A partially written last line is left for a later read. Must be called with both locks held.
+        """
+        try:
+            fp = open(self.index_path, "rb")
+        except FileNotFoundError:
+            self.index, self.index_position, self.index_header = {}, 0, None
+            return
+        with fp:
+            header = fp.readline()
+            if header != self.index_header:
+                # The index was rewritten by an eviction, it is read again from the start
+                self.index, self.index_position, self.index_header = {}, len(header), header
+            fp.seek(self.index_position)
+            data = fp.read()
+
+        complete = data[: data.rfind(b"\n") + 1]
+        for line in complete.splitlines():
+            try:
+                key, segment, offset, height, width = json.loads(line)
+            except ValueError:
+                # Line torn by a process killed while appending
+                continue
+            self.index[key] = [segment, offset, height, width]
+        self.index_position += len(complete)
+
+    def write_index_file(self, entries: dict):
+        """
+        Replaces the index file by a new generation holding the given entries. Must be called with both locks held.
+        """
+        header = json.dumps({"generation": f"{time.time_ns()}-{os.getpid()}"}) + "\n"
+        tmp_path = f"{self.index_path}.tmp"
+        with open(tmp_path, "w") as fp:
+            fp.write(header)
+            fp.writelines(json.dumps([key, *entry]) + "\n" for key, entry in entries.items())
+        os.replace(tmp_path, self.index_path)
+
+    def get(self, image_hash, target_size=None):
+        """
+        Returns the cached (H, W, 3) uint8 frame as a read-only view on a memory-mapped segment, None if missing
+        """
+        key = self.get_key(image_hash, target_size)
+        with self.lock:
+            entry = self.pending.get(key) or self.index.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            segment, offset, height, width = entry
+            end = offset + height * width * 3
+            buffer = self.buffers.get(segment)
+            if buffer is None or len(buffer) < end:
+                try:
+                    buffer = self.buffers[segment] = np.memmap(
+                        self.get_segment_path(segment), dtype=np.uint8, mode="r"
+                    )
+                except FileNotFoundError:
+                    # Segment evicted by another process
+                    self.index.pop(key, None)
+                    self.misses += 1
+                    return None
+            self.hits += 1
+        return buffer[offset:end].reshape(height, width, 3)
+
+    def put(self, image_hash, target_size, frame: np.ndarray):
+        """
+        Appends a (H, W, 3) uint8 frame to the current segment, a new segment is started when it is full
+        """
+        key = self.get_key(image_hash, target_size)
+        frame = np.ascontiguousarray(frame, dtype=np.uint8)
+        if frame.ndim != 3 or frame.shape[2] != 3:
+            raise ValueError(f"Frames must be (H, W, 3) arrays, got shape {frame.shape}")
+
+        with self.lock, file_lock(self.lock_path):
+            # The current segment is read under the file lock, frames appended by other processes are not overwritten
+            segments = self.list_segments()
+            new_segment = (
+                not segments or os.path.getsize(self.get_segment_path(segments[-1])) >= self.segment_size
+            )
+            # Segment names are ordered by creation time, the process id avoids collisions between processes
+            segment = f"frames-{time.time_ns()}-{os.getpid()}" if new_segment else segments[-1]
+            with open(self.get_segment_path(segment), "ab") as fp:
+                offset = fp.seek(0, os.SEEK_END)
+                fp.write(frame.data)
+            self.pending[key] = [segment, offset, frame.shape[0], frame.shape[1]]
+            if new_segment:
+                self.evict()
+            if len(self.pending) >= self.INDEX_FLUSH_INTERVAL:
+                self.write_index()
+
+    def evict(self):
+        """
+        Removes the oldest segments while the cache is larger than max_size, the current segment is kept.
+        The index is rewritten without the entries of evicted segments before their files are removed.
+        Must be called with both locks held.
+        """
+        segments = self.list_segments()
+        sizes = [os.path.getsize(self.get_segment_path(segment)) for segment in segments]
+        total_size = sum(sizes)
+        nb_evicted = 0
+        while total_size > self.max_size and nb_evicted < len(segments) - 1:
+            total_size -= sizes[nb_evicted]
+            nb_evicted += 1
+        if nb_evicted == 0:
+            return
+
+        evicted = set(segments[:nb_evicted])
+        self.write_index()
+        self.write_index_file(
+            {key: entry for key, entry in self.index.items() if entry[0] not in evicted}
+        )
+        self.read_index()
+
+        for segment in evicted:
+            os.remove(self.get_segment_path(segment))
+            # Views already returned keep the segment mapped until they are released
+            self.buffers.pop(segment, None)
+        logging.info(
+            f"Frame cache {self.cache_dir} : {nb_evicted} segments evicted, {total_size} bytes left"
+        )
+
+    def flush(self):
+        """
+        Appends entries added since the last flush to the index file
+        """
+        with self.lock, file_lock(self.lock_path):
+            if self.pending:
+                self.write_index()
+
+    def write_index(self):
+        """
+        Appends new entries to the index file, then reads the entries appended by other processes meanwhile.
+        Entries of frames whose segment was evicted by another process are dropped.
+        Must be called with both locks held.
+        """
+        segments = set(self.list_segments())
+        entries = {key: entry for key, entry in self.pending.items() if entry[0] in segments}
+        self.pending = {}
+        if not os.path.isfile(self.index_path):
+            self.write_index_file(entries)
+        elif entries:
+            lines = "".join(json.dumps([key, *entry]) + "\n" for key, entry in entries.items())
+            with open(self.index_path, "a+b") as fp:
+                # A line torn by a killed process is ended, so that it does not corrupt the next entry
+                fp.seek(-1, os.SEEK_END)
+                if fp.read(1) != b"\n":
+                    lines = "\n" + lines
+                fp.write(lines.encode())
+        self.read_index()
+
+    def __len__(self):
+        return len(self.index) + len(self.pending)
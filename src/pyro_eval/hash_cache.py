@@ -0,0 +1,107 @@
+import json
+import logging
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+from .utils import compute_file_hash
+
+
+class ImageHashCache:
+    """
+    Persistent cache of image hashes, stored in a json file next to the dataset.
+    Each entry is keyed by the resolved file path and is only valid as long as the file size,
+    modification time and inode are unchanged, so a warm lookup only needs to stat the files.
+    Files missing from the cache are hashed in parallel in a process pool.
+    Entries of files that are not part of a full scan of the dataset are pruned.
+    """
+
+    # Below this number of files to hash, spawning a process pool costs more than it saves
+    MIN_FILES_FOR_POOL = 64
+
+    def __init__(self, cache_path, max_workers=None):
+        self.cache_path = str(cache_path)
+        self.max_workers = max_workers
+        self.entries = self.load()
+
+    def load(self):
+        """
+        Loads cache entries from disk, formatted as {path: [size, mtime_ns, inode, hash]}
+        """
+        if not os.path.isfile(self.cache_path):
+            return {}
+        try:
+            with open(self.cache_path, "r") as fp:
+                return json.load(fp)
+        except (OSError, ValueError) as e:
+            logging.warning(f"Unable to read hash cache {self.cache_path}, it will be rebuilt : {e}")
+            return {}
+
+    def save(self):
+        """
+        Writes the cache to disk. The file is written aside and renamed so that an interrupted
+        run never leaves a truncated cache behind.
+        """
+        tmp_path = f"{self.cache_path}.tmp"
+        try:
+            with open(tmp_path, "w") as fp:
+                json.dump(self.entries, fp)
+            os.replace(tmp_path, self.cache_path)
+        except OSError as e:
+            logging.warning(f"Unable to save hash cache in {self.cache_path} : {e}")
+
+    def get_hashes(self, filepaths, full_scan=False):
+        """
+        Returns the hashes of the given files, in the same order.
+        Only files that are new or changed since the last call are read and hashed.
+        With full_scan, filepaths are all the files of the dataset : entries of other files, deleted or
+        moved since they were cached, are removed from the cache.
+        """
+        # Paths are resolved so that a dataset opened from another working directory hits the same entries
+        filepaths = [os.path.realpath(filepath) for filepath in filepaths]
+        hashes = [None] * len(filepaths)
+        misses = []
+
+        for i, filepath in enumerate(filepaths):
+            stat = os.stat(filepath)
+            key = [stat.st_size, stat.st_mtime_ns, stat.st_ino]
+            entry = self.entries.get(filepath)
+            if entry is not None and entry[:3] == key:
+                hashes[i] = entry[3]
+            else:
+                misses.append((i, key))
+
+        if misses:
+            logging.info(
+                f"Hashing {len(misses)} images ({len(filepaths) - len(misses)} found in cache)"
+            )
+            missing_paths = [filepaths[i] for i, _ in misses]
+            for (i, key), file_hash in zip(misses, self.compute_hashes(missing_paths)):
+                hashes[i] = file_hash
+                self.entries[filepaths[i]] = key + [file_hash]
+
+        nb_pruned = 0
+        if full_scan:
+            scanned = set(filepaths)
+            stale_paths = [filepath for filepath in self.entries if filepath not in scanned]
+            for filepath in stale_paths:
+                del self.entries[filepath]
+            nb_pruned = len(stale_paths)
+            if nb_pruned:
+                logging.info(f"Removed {nb_pruned} entries of missing files from the hash cache")
+
+        if misses or nb_pruned:
+            self.save()
+
+        return hashes
+
+    def compute_hashes(self, filepaths):
+        """
+        Hashes files, using a process pool when there are enough of them
+        """
+        if len(filepaths) < self.MIN_FILES_FOR_POOL or self.max_workers == 1:
+            return [compute_file_hash(filepath) for filepath in filepaths]
+
+        max_workers = self.max_workers or os.cpu_count() or 1
+        chunksize = max(1, len(filepaths) // (max_workers * 8))
+        with ProcessPoolExecutor(max_workers=max_workers) as executor:
+            return list(executor.map(compute_file_hash, filepaths, chunksize=chunksize))
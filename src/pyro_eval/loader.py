@@ -0,0 +1,188 @@
+import logging
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, wait
+from typing import Iterable, Optional
+
+import numpy as np
+from PIL import Image as PILImage
+
+from .data_structures import CustomImage
+from .frame_cache import FrameCache
+
+
+class ImageLoader:
+    """
+    Loads and decodes images ahead of their use on a thread pool, so that inference does not wait on disk reads
+    and JPEG decoding. At most `prefetch` images are pending at once, and images are yielded in input order,
+    which keeps the order of images within sequences for the engine.
+    If target_size is provided, images are decoded at a reduced resolution, see CustomImage.load().
+    If a FrameCache is provided, decoded frames are read from it and images missing from it are added.
+
+    for image, pil_image in ImageLoader(images):
+        ...
+
+    A loader can also be kept to load several lists of images on the same threads, with load(), and closed
+    with close() once done.
+    """
+
+    def __init__(
+        self,
+        images: Iterable[CustomImage] = (),
+        num_workers: int = 4,
+        prefetch: int = 8,
+        target_size=None,
+        frame_cache: Optional[FrameCache] = None,
+    ):
+        self.images = images
+        self.target_size = target_size
+        self.frame_cache = frame_cache
+        self.num_workers = max(1, num_workers)
+        self.prefetch = max(1, prefetch)
+        self.executor = None
+        self.reset_stats()
+
+    def reset_stats(self):
+        self.nb_images = 0
+        self.decode_time = 0.0  # Time spent loading images in the worker threads
+        self.wait_time = 0.0  # Time the consumer spent waiting for an image not ready yet
+        self.queue_depth_sum = 0
+        self.max_queue_depth = 0
+        self.nb_cached_frames = 0  # Images read from the frame cache instead of being decoded
+
+    def decode(self, image: CustomImage):
+        """
+        Loads an image and forces its decoding, PIL only reads the header when an image is opened
+        Returns the image, the time spent and whether the image was read from the frame cache
+        """
+        start = time.perf_counter()
+        if self.frame_cache is not None:
+            frame = self.frame_cache.get(image.hash, self.target_size)
+            if frame is not None:
+                # PIL cannot share memory with an RGB array, this is the only copy of the cached frame
+                return PILImage.fromarray(frame), time.perf_counter() - start, True
+
+        pil_image = image.load(self.target_size)
+        if pil_image is not None:
+            try:
+                pil_image.load()
+            except Exception as e:
+                logging.error(f"Unable to decode image : {image.path} : {e}")
+                pil_image = None
+
+        if pil_image is not None and self.frame_cache is not None:
+            if pil_image.mode != "RGB":
+                pil_image = pil_image.convert("RGB")
+            self.frame_cache.put(image.hash, self.target_size, np.asarray(pil_image))
+        return pil_image, time.perf_counter() - start, False
+
+    def __iter__(self):
+        try:
+            yield from self.load(self.images)
+        finally:
+            self.close()
+
+    def load(self, images: Iterable[CustomImage]):
+        """
+        Yields the images and their decoded PIL image, statistics are reset for each call
+        """
+        self.reset_stats()
+        if self.executor is None:
+            self.executor = ThreadPoolExecutor(max_workers=self.num_workers)
+        images = iter(images)
+        pending = deque()
+        try:
+            # Fill the queue, then submit a new image each time one is consumed
+            for image in images:
+                pending.append((image, self.executor.submit(self.decode, image)))
+                if len(pending) >= self.prefetch:
+                    break
+
+            while pending:
+                image, future = pending.popleft()
+                # Number of images already decoded when the consumer asks for the next one
+                queue_depth = future.done() + sum(f.done() for _, f in pending)
+                self.queue_depth_sum += queue_depth
+                self.max_queue_depth = max(self.max_queue_depth, queue_depth)
+
+                next_image = next(images, None)
+                if next_image is not None:
+                    pending.append((next_image, self.executor.submit(self.decode, next_image)))
+
+                start = time.perf_counter()
+                pil_image, decode_time, cached = future.result()
+                self.wait_time += time.perf_counter() - start
+                self.decode_time += decode_time
+                self.nb_cached_frames += cached
+                self.nb_images += 1
+
+                yield image, pil_image
+        finally:
+            # Stop decoding if the consumer stops early, images already being decoded are waited for
+            for _, future in pending:
+                future.cancel()
+            wait([future for _, future in pending])
+            # New frames are indexed once all decoding threads are done
+            if self.frame_cache is not None:
+                self.frame_cache.flush()
+
+    def close(self):
+        """
+        Stops the loading threads
+        """
+        if self.executor is not None:
+            self.executor.shutdown()
+            self.executor = None
+
+    def get_stats(self):
+        """
+        Returns loader statistics : decode time is summed over worker threads, wait time is the time inference
+        spent waiting for images. A low average queue depth means loading is the bottleneck.
+        """
+        nb_images = max(self.nb_images, 1)
+        return {
+            "nb_images": self.nb_images,
+            "num_workers": self.num_workers,
+            "prefetch": self.prefetch,
+            "decode_time": self.decode_time,
+            "avg_decode_ms": 1000 * self.decode_time / nb_images,
+            "wait_time": self.wait_time,
+            "avg_queue_depth": self.queue_depth_sum / nb_images,
+            "max_queue_depth": self.max_queue_depth,
+            "nb_cached_frames": self.nb_cached_frames,
+        }
+
+    def log_stats(self):
+        log_loader_stats(self.get_stats())
+
+
+def log_loader_stats(stats):
+    logging.info(
+        f"Image loader : {stats['nb_images']} images, avg decode {stats['avg_decode_ms']:.1f} ms, "
+        f"waited {stats['wait_time']:.2f} s, avg queue depth {stats['avg_queue_depth']:.1f}/{stats['prefetch']}, "
+        f"{stats['nb_cached_frames']} read from frame cache"
+    )
+
+
+def merge_loader_stats(stats_list):
+    """
+    Merges the statistics of several loaders, from parallel workers for instance
+    """
+    stats_list = [stats for stats in stats_list if stats is not None]
+    if not stats_list:
+        return None
+    nb_images = sum(stats["nb_images"] for stats in stats_list)
+    decode_time = sum(stats["decode_time"] for stats in stats_list)
+    return {
+        "nb_images": nb_images,
+        "num_workers": stats_list[0]["num_workers"],
+        "prefetch": stats_list[0]["prefetch"],
+        "decode_time": decode_time,
+        "avg_decode_ms": 1000 * decode_time / max(nb_images, 1),
+        "wait_time": sum(stats["wait_time"] for stats in stats_list),
+        "avg_queue_depth": sum(
+            stats["avg_queue_depth"] * stats["nb_images"] for stats in stats_list
+        ) / max(nb_images, 1),
+        "max_queue_depth": max(stats["max_queue_depth"] for stats in stats_list),
+        "nb_cached_frames": sum(stats["nb_cached_frames"] for stats in stats_list),
+    }
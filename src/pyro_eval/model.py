@@ -1,26 +1,147 @@
+import hashlib
+import json
 import logging
 import os
+import platform
+from contextlib import contextmanager
+from typing import List
 
 import numpy as np
 import onnxruntime
 import torch
+from onnxruntime import InferenceSession
 from huggingface_hub import HfApi, HfFolder, hf_hub_download
 from huggingface_hub.utils import HfHubHTTPError
 from pyroengine.vision import Classifier
 from ultralytics import YOLO
 
 from .data_structures import CustomImage
+from .utils import compute_file_hash
+
+ORT_EXECUTION_MODES = {
+    "sequential": onnxruntime.ExecutionMode.ORT_SEQUENTIAL,
+    "parallel": onnxruntime.ExecutionMode.ORT_PARALLEL,
+}
+ORT_OPTIMIZATION_LEVELS = {
+    "disable": onnxruntime.GraphOptimizationLevel.ORT_DISABLE_ALL,
+    "basic": onnxruntime.GraphOptimizationLevel.ORT_ENABLE_BASIC,
+    "extended": onnxruntime.GraphOptimizationLevel.ORT_ENABLE_EXTENDED,
+    "all": onnxruntime.GraphOptimizationLevel.ORT_ENABLE_ALL,
+}
+
+
+def create_onnx_session(model_path, session_params=None, providers=None):
+    """
+    Creates an onnxruntime session configured with session_params :
+    - intra_op_num_threads, inter_op_num_threads (int) : onnxruntime defaults if not set
+    - execution_mode : "sequential" (default) or "parallel"
+    - graph_optimization_level : "disable", "basic", "extended" or "all" (default)
+    - optimized_model_cache : directory where optimized graphs are saved, "data/ort_cache" by default, None to disable.
+    Optimized graphs are keyed by model hash, optimization level, onnxruntime version, providers and platform as
+    they are specific to the environment. Sessions created from a cached graph skip graph optimization.
+    Returns the session and a description of the options used, to be recorded with the metrics.
+    """
+    session_params = session_params or {}
+    providers = providers or onnxruntime.get_available_providers()
+    options = onnxruntime.SessionOptions()
+
+    for param in ["intra_op_num_threads", "inter_op_num_threads"]:
+        if session_params.get(param) is not None:
+            setattr(options, param, int(session_params[param]))
+
+    execution_mode = session_params.get("execution_mode", "sequential")
+    optimization_level = session_params.get("graph_optimization_level", "all")
+    if execution_mode not in ORT_EXECUTION_MODES:
+        raise ValueError(f"Unknown onnxruntime execution mode : {execution_mode}")
+    if optimization_level not in ORT_OPTIMIZATION_LEVELS:
+        raise ValueError(f"Unknown onnxruntime graph optimization level : {optimization_level}")
+    options.execution_mode = ORT_EXECUTION_MODES[execution_mode]
+    options.graph_optimization_level = ORT_OPTIMIZATION_LEVELS[optimization_level]
+
+    session_path = model_path
+    optimized_path, tmp_path, cached = None, None, False
+    cache_dir = session_params.get("optimized_model_cache", "data/ort_cache")
+    if cache_dir and optimization_level != "disable":
+        key = hashlib.sha256(
+            json.dumps(
+                {
+                    "model_hash": compute_file_hash(model_path),
+                    "graph_optimization_level": optimization_level,
+                    "onnxruntime": onnxruntime.__version__,
+                    "providers": providers,
+                    "platform": platform.machine(),
+                },
+                sort_keys=True,
+            ).encode()
+        ).hexdigest()
+        optimized_path = os.path.join(cache_dir, f"{key}.onnx")
+        if os.path.isfile(optimized_path):
+            # The graph is already optimized
+            session_path = optimized_path
+            options.graph_optimization_level = ORT_OPTIMIZATION_LEVELS["disable"]
+            cached = True
+        else:
+            # Written aside and renamed, other processes may create the same session
+            os.makedirs(cache_dir, exist_ok=True)
+            tmp_path = f"{optimized_path}.{os.getpid()}.tmp"
+            options.optimized_model_filepath = tmp_path
+
+    # The class imported with the module is used, onnxruntime.InferenceSession is replaced in configured_onnx_sessions
+    session = InferenceSession(session_path, sess_options=options, providers=providers)
+    if tmp_path is not None and os.path.isfile(tmp_path):
+        os.replace(tmp_path, optimized_path)
+        logging.info(f"Optimized onnx graph saved in {optimized_path}")
+
+    description = {
+        "intra_op_num_threads": options.intra_op_num_threads,
+        "inter_op_num_threads": options.inter_op_num_threads,
+        "execution_mode": execution_mode,
+        "graph_optimization_level": optimization_level,
+        "providers": session.get_providers(),
+        "optimized_model": optimized_path,
+        "optimized_model_cached": cached,
+    }
+    return session, description
+
+
+@contextmanager
+def configured_onnx_sessions(session_params=None):
+    """
+    Sessions created with onnxruntime.InferenceSession in this context are created by create_onnx_session with
+    session_params, on the providers requested by the caller. Objects that create their own session, such as the
+    pyroengine Classifier, are built directly with a configured session.
+    Yields a list filled with the descriptions of the sessions created.
+    """
+    descriptions = []
+
+    def create_session(model_path, sess_options=None, providers=None, **kwargs):
+        session, description = create_onnx_session(model_path, session_params, providers=providers)
+        descriptions.append(description)
+        return session
+
+    onnxruntime.InferenceSession = create_session
+    try:
+        yield descriptions
+    finally:
+        onnxruntime.InferenceSession = InferenceSession
 
 
 class Model:
-    def __init__(self, model_path, inference_params, device=None):
+    def __init__(self, model_path, inference_params, device=None, session_params=None):
         self.model_path = model_path
+        self.format = None
+        # onnxruntime session options, see create_onnx_session
+        self.session_params = session_params or {}
+        self.session_description = None
+        self.onnx_batch = None  # Whether the onnx model accepts batches, see onnx_supports_batch()
+        # Inference parameters are needed to load onnx models
+        self.inference_params = self.set_inference_params(inference_params)
 
         self.model = self.load_model()
         self.device = self.get_device(device)
-        self.model.to(self.device)
-        self.format = None
-        self.inference_params = self.set_inference_params(inference_params)
+        if self.format != "onnx":
+            # The onnx Classifier runs on onnxruntime and has no device to move to
+            self.model.to(self.device)
 
     def load_model(self):
         if not self.model_path:
@@ -55,12 +176,15 @@ class Model:
         try:
             # This object is created to use the pre-processing and post-processing from the engine
             # Parameters are set to remove any filter of the preds
-            model = Classifier(
-                model_path=self.model_path,
-                format="onnx",
-                conf=self.inference_params["conf"],
-                max_bbox_size=1
-            )
+            # The Classifier session is created with the configured options
+            with configured_onnx_sessions(self.session_params) as session_descriptions:
+                model = Classifier(
+                    model_path=self.model_path,
+                    format="onnx",
+                    conf=self.inference_params["conf"],
+                    max_bbox_size=1
+                )
+            self.session_description = session_descriptions[-1] if session_descriptions else None
         except Exception as e:
             raise RuntimeError(
                 f"Failed to load the ONNX model from {self.model_path}: {str(e)}"
@@ -120,37 +244,176 @@ class Model:
             "imgsz": inference_params.get("imgsz", 1024),
         }
 
-    def inference(self, image: CustomImage):
+    def get_input_size(self):
+        """
+        Returns the size of the model input. The model resizes images to this size, so they can be loaded
+        directly at this size to save decoding time.
+        """
+        if isinstance(self.model, Classifier):
+            return self.model.imgsz
+        return self.inference_params["imgsz"]
+
+    def inference(self, image: CustomImage, pil_image=None):
         """
         Reads an image and run the model on it.
+        pil_image can be provided when the image has already been loaded, by an ImageLoader for instance.
+        """
+        pil_images = [pil_image] if pil_image is not None else None
+        return self.inference_batch([image], pil_images)[0]
+
+    def inference_batch(self, images: List[CustomImage], pil_images=None, batch_size=None):
+        """
+        Runs the model on a list of images, by batches of batch_size images (all images at once by default).
+        pil_images can be provided when images have already been loaded.
+        Returns a list of predictions formatted as [[x1, y1, x2, y2, confidence]] with xyxyn boxes, in the same
+        order as images. Images that could not be loaded or processed get an empty prediction.
         """
-        pil_image = image.load()
+        if pil_images is None:
+            pil_images = [image.load(self.get_input_size()) for image in images]
+        batch_size = batch_size or max(len(images), 1)
 
+        predictions = []
+        for start in range(0, len(images), batch_size):
+            predictions.extend(
+                self.predict_batch(
+                    images[start : start + batch_size],
+                    pil_images[start : start + batch_size],
+                )
+            )
+        return predictions
+
+    def predict_batch(self, images, pil_images):
+        """
+        Runs the model on a single batch. If the batch fails, images are processed one by one so that
+        a single faulty image does not discard the predictions of the whole batch.
+        """
+        predictions = [[] for _ in images]
+        valid = [i for i, pil_image in enumerate(pil_images) if pil_image is not None]
+        for i in set(range(len(images))) - set(valid):
+            logging.error(f"Inference skipped, image could not be loaded : {images[i].path}")
+        if not valid:
+            return predictions
+
+        try:
+            batch_predictions = self.run_model([pil_images[i] for i in valid])
+        except Exception as e:
+            if len(valid) == 1:
+                logging.error(f"Inference failed on {images[valid[0]].path} : {e}")
+                return predictions
+            logging.warning(f"Batch inference failed, images are processed one by one : {e}")
+            for i in valid:
+                predictions[i] = self.predict_batch([images[i]], [pil_images[i]])[0]
+            return predictions
+
+        for i, prediction in zip(valid, batch_predictions):
+            predictions[i] = prediction
+        return predictions
+
+    def run_model(self, pil_images):
+        """
+        Runs the model on a batch of PIL images
+        """
         if self.format == "onnx":
-            try:
-                # Returns an array of predicitions with boxes xyxyn and confidence
-                prediction = self.model(pil_image) # [[x1, y1, x2, y2, confidence]]
-            except Exception as e:
-                logging.error(f"Onnx inference failed on {image.path} : {e}")
-                prediction = []
-        else:
-            try:
-                results = self.model.predict(
-                    source=pil_image,
-                    conf=self.inference_params["conf"],
-                    iou=self.inference_params["iou"],
-                    imgsz=self.inference_params["imgsz"],
-                    device=self.device,
-                )[0]
-                # Format predictions to onnx format : [[boxes.xyxyn, conf]]
-                prediction = []
-                for box in results.boxes:
-                    xyxyn = box.xyxyn.cpu().numpy().flatten()  # [x1, y1, x2, y2]
-                    conf = box.conf.cpu().item()
-                    prediction.append([*xyxyn, conf])
-
-            except Exception as e:
-                logging.error(f"Inference failed on {image.path} : {e}")
-                prediction = []
-
-        return prediction
+            return self.run_onnx(pil_images)
+
+        results = self.model.predict(
+            source=pil_images,
+            conf=self.inference_params["conf"],
+            iou=self.inference_params["iou"],
+            imgsz=self.inference_params["imgsz"],
+            device=self.device,
+            verbose=False,
+        )
+        # Format predictions to onnx format : [[boxes.xyxyn, conf]]
+        return [
+            np.concatenate(
+                [
+                    result.boxes.xyxyn.cpu().numpy(),  # [x1, y1, x2, y2]
+                    result.boxes.conf.cpu().numpy()[:, None],
+                ],
+                axis=1,
+            ).tolist()
+            for result in results
+        ]
+
+    def run_onnx(self, pil_images):
+        """
+        Runs the onnx Classifier on a batch of images.
+        The Classifier pre-processing and post-processing are applied to each image, and the onnx session is run
+        once on the whole batch when the model has a dynamic batch dimension. Otherwise images are processed
+        one by one.
+        """
+        if not self.onnx_supports_batch() or len(pil_images) == 1:
+            # Returns an array of predicitions with boxes xyxyn and confidence
+            return [self.model(pil_image) for pil_image in pil_images] # [[x1, y1, x2, y2, confidence]]
+
+        inputs, pads = zip(*[self.model.prep_process(pil_image) for pil_image in pil_images])
+        session = self.model.ort_session
+        outputs = session.run(
+            None, {session.get_inputs()[0].name: np.concatenate(inputs, axis=0)}
+        )[0]
+
+        predictions = []
+        for output, pad in zip(outputs, pads):
+            prediction = np.clip(self.model.post_process(output, pad), 0, 1)
+            # Same filtering as the Classifier call
+            prediction = prediction[
+                (prediction[:, 2] - prediction[:, 0]) < self.model.max_bbox_size, :
+            ]
+            predictions.append(np.reshape(prediction, (-1, 5)))
+        return predictions
+
+    def onnx_supports_batch(self):
+        """
+        Batches can only be run through the onnx session if the model input has a dynamic batch dimension
+        """
+        if self.onnx_batch is None:
+            session = getattr(self.model, "ort_session", None)
+            self.onnx_batch = (
+                session is not None
+                and hasattr(self.model, "prep_process")
+                and hasattr(self.model, "post_process")
+                and not isinstance(session.get_inputs()[0].shape[0], int)
+            )
+        return self.onnx_batch
+
+
+class BatchSizeTuner:
+    """
+    Chooses the inference batch size from measured latency.
+    The batch size is doubled as long as the time per image decreases by at least min_gain, then it is set to the
+    best value found. The first batch is not measured as it includes the model warmup.
+    """
+
+    def __init__(self, max_batch_size=32, min_gain=0.1):
+        self.batch_size = 1
+        self.max_batch_size = max_batch_size
+        self.min_gain = min_gain
+        self.best_batch_size = 1
+        self.best_latency = None
+        self.warmup = True
+        self.done = max_batch_size <= 1
+
+    def update(self, nb_images, duration):
+        """
+        Records the duration of a batch of nb_images
+        """
+        if self.done or nb_images < self.batch_size:
+            # Incomplete batches are not representative
+            return
+        if self.warmup:
+            self.warmup = False
+            return
+
+        latency = duration / nb_images
+        if self.best_latency is None or latency < self.best_latency * (1 - self.min_gain):
+            self.best_latency = latency
+            self.best_batch_size = self.batch_size
+            if self.batch_size * 2 <= self.max_batch_size:
+                self.batch_size *= 2
+                return
+        self.batch_size = self.best_batch_size
+        self.done = True
+        logging.info(
+            f"Inference batch size set to {self.batch_size} ({1000 * self.best_latency:.1f} ms per image)"
+        )
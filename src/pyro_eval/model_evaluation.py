@@ -1,18 +1,147 @@
-import json
 import logging
+import multiprocessing
 import os
-from pathlib import Path
+import time
+from concurrent.futures import ProcessPoolExecutor
 from typing import List
 
 import numpy as np
+import torch
 
 from .dataset import EvaluationDataset
-from .data_structures import CustomImage
-from .model import Model
-from .utils import compute_metrics, make_dict_json_compatible, find_matches
+from .data_structures import CustomImage, ImageTable
+from .frame_cache import FrameCache
+from .loader import ImageLoader, log_loader_stats, merge_loader_stats
+from .model import BatchSizeTuner, Model
+from .prediction_store import PredictionStore
+from .utils import (
+    compute_metrics,
+    compute_pr_curve,
+    filter_ragged,
+    find_matches_batched,
+    ragged_array,
+)
+
+
+# Model, frame cache and image loader created once in each worker process of a parallel prediction run
+worker_model = None
+worker_loader = None
+
+
+def init_prediction_worker(
+    model_path,
+    inference_params,
+    device,
+    num_threads,
+    session_params=None,
+    batch_size=1,
+    loader_workers=4,
+    prefetch=8,
+    frame_cache_dir=None,
+    frame_cache_size=None,
+):
+    """
+    Initializes a worker process : limits the number of intra-op threads, loads the model and creates the image
+    loader used for all shards of the worker, with its threads and frame cache
+    """
+    global worker_model, worker_loader
+    os.environ["OMP_NUM_THREADS"] = str(num_threads)
+    torch.set_num_threads(num_threads)
+    session_params = dict(session_params or {})
+    session_params.setdefault("intra_op_num_threads", num_threads)
+    worker_model = Model(model_path, inference_params, device, session_params)
+    frame_cache = FrameCache(frame_cache_dir, max_size=frame_cache_size) if frame_cache_dir else None
+    worker_loader = create_loader(worker_model, batch_size, loader_workers, prefetch, frame_cache)
+
+
+def predict_shard(table: ImageTable, batch_size):
+    """
+    Runs the model of the worker process on all images of a shard
+    """
+    images = [CustomImage.view(table, index) for index in range(len(table))]
+    return predict_images(worker_model, images, batch_size, worker_loader)
+
+
+def create_loader(model: Model, batch_size=1, loader_workers=4, prefetch=8, frame_cache: FrameCache = None):
+    """
+    Creates an ImageLoader decoding images at the model input size
+    """
+    return ImageLoader(
+        num_workers=loader_workers,
+        # Enough images are decoded in advance to fill the next batch
+        prefetch=max(prefetch, batch_size),
+        target_size=model.get_input_size(),
+        frame_cache=frame_cache,
+    )
+
+
+def iter_predictions(model: Model, images: List[CustomImage], batch_size, loader: ImageLoader):
+    """
+    Runs a model on images loaded ahead by an ImageLoader, by batches of batch_size images.
+    Yields the images of each batch and their predictions.
+    """
+    batch = []
+    for nb_loaded, loaded_image in enumerate(loader.load(images), 1):
+        batch.append(loaded_image)
+        if len(batch) < batch_size and nb_loaded < len(images):
+            continue
+
+        batch_images, pil_images = zip(*batch)
+        yield batch_images, model.inference_batch(list(batch_images), list(pil_images))
+        batch = []
+
+
+def predict_images(model: Model, images: List[CustomImage], batch_size, loader: ImageLoader):
+    """
+    Runs a model on images by batches of batch_size images, see iter_predictions.
+    Returns the predictions, in the order of images, and the loader statistics.
+    """
+    predictions = []
+    for _, batch_predictions in iter_predictions(model, images, batch_size, loader):
+        predictions.extend(batch_predictions)
+    return predictions, loader.get_stats()
+
+
+def tune_batch_size(
+    model: Model,
+    images: List[CustomImage],
+    max_batch_size=32,
+    loader_workers=4,
+    frame_cache: FrameCache = None,
+):
+    """
+    Chooses the inference batch size with a BatchSizeTuner, on batches of the first images whose predictions are
+    discarded. The batch size is chosen before predictions : all batches of a run have the same size, so that
+    predictions do not depend on latency measurements.
+    """
+    batch_sizer = BatchSizeTuner(max_batch_size=max_batch_size)
+    # A warmup batch, then batches of doubling size up to max_batch_size
+    loaded_images = list(
+        ImageLoader(
+            images[: 2 * max_batch_size],
+            num_workers=loader_workers,
+            target_size=model.get_input_size(),
+            frame_cache=frame_cache,
+        )
+    )
+    position = 0
+    while loaded_images and not batch_sizer.done:
+        # Images are reused when there are not enough of them
+        batch = [
+            loaded_images[(position + i) % len(loaded_images)] for i in range(batch_sizer.batch_size)
+        ]
+        position += len(batch)
+        batch_images, pil_images = zip(*batch)
+        start = time.perf_counter()
+        model.inference_batch(list(batch_images), list(pil_images))
+        batch_sizer.update(len(batch), time.perf_counter() - start)
+    return batch_sizer.batch_size
 
 
 class ModelEvaluator:
+    # Maximum number of points of the precision-recall curve written in the metrics
+    PR_CURVE_POINTS = 1000
+
     def __init__(
         self,
         dataset: EvaluationDataset,
@@ -26,10 +155,43 @@ class ModelEvaluator:
         self.use_existing_predictions = use_existing_predictions
         self.model_path = self.config.get("model_path", None)
         self.inference_params = self.config.get("inference_params", {})
+        # With pr_curve, predictions are computed once at conf_floor : metrics are reported at the configured
+        # confidence threshold, and a precision-recall curve is computed over all thresholds above conf_floor
+        self.pr_curve = self.config.get("pr_curve", False)
+        self.conf_floor = self.config.get("conf_floor", 0.01)
+        self.conf_threshold = self.inference_params.get("conf", 0.05)
+        if self.pr_curve:
+            self.inference_params = {
+                **self.inference_params,
+                "conf": min(self.conf_floor, self.conf_threshold),
+            }
+        # onnxruntime session options for onnx models, see create_onnx_session
+        self.session_params = self.config.get("session_params", {})
         self.iou_threshold = self.config.get("iou", 0.1)
+        # Images are decoded ahead of inference by an ImageLoader
+        self.loader_workers = self.config.get("loader_workers", 4)
+        self.prefetch = self.config.get("prefetch", 8)
+        # Decoded frames can be cached on disk and shared between models and runs
+        self.frame_cache_dir = self.config.get("frame_cache")
+        self.frame_cache_size = self.config.get("frame_cache_size", 10 * 1024**3)
+        self.frame_cache = (
+            FrameCache(self.frame_cache_dir, max_size=self.frame_cache_size) if self.frame_cache_dir else None
+        )
+        self.loader_stats = None
+        # Fixed inference batch size, chosen from measured latency if not provided
+        self.batch_size = self.config.get("batch_size")
+        self.max_batch_size = self.config.get("max_batch_size", 32)
+        # Predictions run in num_workers processes if num_workers > 1
+        self.num_workers = self.config.get("num_workers", 1)
+        self.threads_per_worker = self.config.get("threads_per_worker")
+        self.shard_size = self.config.get("shard_size", 256)
+        # Number of new predictions after which they are saved in the prediction store
+        self.flush_interval = self.config.get("flush_interval", 1024)
+        # Number of prediction segments from which they are merged at the end of a run
+        self.compact_segments = self.config.get("compact_segments", 16)
 
         # Load model
-        self.model = Model(self.model_path, self.inference_params, device)
+        self.model = Model(self.model_path, self.inference_params, device, self.session_params)
 
         # Retrieve images from the dataset
         self.images = self.dataset.get_all_images()
@@ -42,64 +204,143 @@ class ModelEvaluator:
             "fn": [],
         }
 
-        self.prediction_file = self.get_prediction_path()
-
-    def get_prediction_path(self):
-        abs_model_path = Path(self.model_path).resolve()
-        output_dir = Path("data/predictions")
-
-        # Try to take the relative path from the models folder, only work if the model path points to this folder
-        try:
-            relative = abs_model_path.relative_to(abs_model_path.parents[abs_model_path.parts.index("models")])
-        except ValueError:
-            # otherwise we use only the last subfolders
-            relative = Path(*abs_model_path.parts[-2:])
-
-        output_name = "_".join(relative.parts).replace(".pt", "") + ".json"
-
-        return output_dir / output_name
+        # Predictions are stored by model file hash, inference parameters and image content hash
+        self.prediction_store = PredictionStore(
+            self.config.get("prediction_store", "data/predictions"),
+            self.model_path,
+            self.model.inference_params,
+        )
 
     def run_predictions(self, image_list : List[CustomImage] = None):
         """
         Run predictions on a list of CustomImage objects
         By default runs on all images in the dataset
-        Saves results in a json to avoid recomputation on different runs with the same model
+        Saves results in the prediction store to avoid recomputation on different runs with the same model.
+        Predictions are flushed to the store every flush_interval images, so that an interrupted run only loses
+        the predictions of the last images : they are resumed from the store by load_predictions.
         """
         # Run pred for each CustomImage in the EvaluationDataset
         image_list = image_list or self.images
-        predictions = {}
-        for image in image_list:
-            image.prediction = self.model.inference(image)
-            predictions[image.name] = image.prediction
+        if not self.batch_size:
+            # Tuned on the images to predict only, a fully stored dataset needs no latency measurement
+            self.batch_size = tune_batch_size(
+                self.model,
+                image_list,
+                max_batch_size=self.max_batch_size,
+                loader_workers=self.loader_workers,
+                frame_cache=self.frame_cache,
+            )
+        if self.num_workers > 1 and len(image_list) > 1:
+            chunks = self.run_parallel_predictions(image_list)
+        else:
+            chunks = self.run_serial_predictions(image_list)
+
+        loader_stats = []
+        pending_images, pending_predictions = [], []
+        for images, predictions, stats in chunks:
+            loader_stats.append(stats)
+            for image, prediction in zip(images, predictions):
+                image.prediction = prediction
+            pending_images.extend(images)
+            pending_predictions.extend(predictions)
+            if len(pending_images) >= self.flush_interval:
+                self.prediction_store.add([image.hash for image in pending_images], pending_predictions)
+                pending_images, pending_predictions = [], []
 
         # Save predictions for later use
-        if not os.path.isfile(self.prediction_file):
-            with open(self.prediction_file, 'w') as fp:
-                json.dump(make_dict_json_compatible(predictions), fp)
+        self.prediction_store.add([image.hash for image in pending_images], pending_predictions)
+        self.prediction_store.compact(min_segments=self.compact_segments)
+
+        self.loader_stats = merge_loader_stats(loader_stats)
+        if self.loader_stats is not None:
+            log_loader_stats(self.loader_stats)
+
+    def run_serial_predictions(self, image_list: List[CustomImage]):
+        """
+        Runs predictions in the current process, on images decoded by a single ImageLoader for the whole run.
+        Yields the images of each chunk of flush_interval images, cut at multiples of the batch size, and their
+        predictions as soon as the chunk is predicted, with the loader statistics on the last chunk.
+        """
+        chunk_size = max(self.batch_size, self.flush_interval // self.batch_size * self.batch_size)
+        loader = create_loader(self.model, self.batch_size, self.loader_workers, self.prefetch, self.frame_cache)
+        try:
+            images, predictions = [], []
+            for batch_images, batch_predictions in iter_predictions(
+                self.model, image_list, self.batch_size, loader
+            ):
+                images.extend(batch_images)
+                predictions.extend(batch_predictions)
+                if len(images) >= chunk_size:
+                    yield images, predictions, None
+                    images, predictions = [], []
+            yield images, predictions, loader.get_stats()
+        finally:
+            loader.close()
+
+    def run_parallel_predictions(self, image_list: List[CustomImage]):
+        """
+        Runs predictions in num_workers processes that each load the model once.
+        Images are sent to workers by shards, gathered in compact ImageTable objects. Shards are cut at multiples of
+        the batch size, so that batches, and thus predictions, are the same as in a serial run with this batch size.
+        Each worker is limited to threads_per_worker intra-op threads so that the machine is not oversubscribed.
+        Yields the images of each shard, their predictions and the loader statistics, in the order of image_list.
+        """
+        shard_size = max(self.batch_size, self.shard_size // self.batch_size * self.batch_size)
+        num_threads = self.threads_per_worker or max(1, (os.cpu_count() or 1) // self.num_workers)
+        logging.info(
+            f"Running predictions in {self.num_workers} processes with {num_threads} threads each, "
+            f"by shards of {shard_size} images"
+        )
+
+        starts = range(0, len(image_list), shard_size)
+        shards = [ImageTable.from_images(image_list[start : start + shard_size]) for start in starts]
+        with ProcessPoolExecutor(
+            max_workers=self.num_workers,
+            # Processes are spawned, forking a process that already runs torch or onnxruntime is not safe
+            mp_context=multiprocessing.get_context("spawn"),
+            initializer=init_prediction_worker,
+            initargs=(
+                self.model_path,
+                self.inference_params,
+                str(self.model.device),
+                num_threads,
+                self.session_params,
+                self.batch_size,
+                self.loader_workers,
+                self.prefetch,
+                self.frame_cache_dir,
+                self.frame_cache_size,
+            ),
+        ) as executor:
+            futures = [executor.submit(predict_shard, shard, self.batch_size) for shard in shards]
+            try:
+                for start, future in zip(starts, futures):
+                    predictions, stats = future.result()
+                    yield image_list[start : start + shard_size], predictions, stats
+            finally:
+                # Pending shards are not run if the run is interrupted
+                for future in futures:
+                    future.cancel()
 
     def load_predictions(self):
         """
-        Load prediction from a json file.
-        Predictions are saved in a json named following the model path.
+        Load predictions from the prediction store, images are looked up by content hash.
+        Predictions of images missing from the store are computed and added to the store.
         """
-        if not os.path.isfile(self.prediction_file):
-            logging.info(f"Prediction file not found : {self.prediction_file}")
-            logging.info("Running predictions.")
-            self.run_predictions()
-        else:
-            # Load predictions from json file
-            with open(self.prediction_file, 'r') as fp:
-                predictions = json.load(fp)
-            missing_predictions = []
-            for image in self.images:
-                if image.name in predictions:
-                    image.prediction = np.array(predictions[image.name])
-                else:
-                    missing_predictions.append(image)
-
-            # Run predictions on images which are missing in the json file
-            if len(missing_predictions):
-                self.run_predictions(image_list=missing_predictions)
+        missing_predictions = []
+        stored_predictions = self.prediction_store.get([image.hash for image in self.images])
+        for image, prediction in zip(self.images, stored_predictions):
+            if prediction is not None:
+                image.prediction = prediction
+            else:
+                missing_predictions.append(image)
+
+        # Run predictions on images which are missing in the store
+        if len(missing_predictions):
+            logging.info(
+                f"{len(missing_predictions)} images not found in prediction store {self.prediction_store.store_dir}"
+            )
+            self.run_predictions(image_list=missing_predictions)
 
     def track_predictions(self, fp, tp, fn, image_path):
         """
@@ -114,6 +355,39 @@ class ModelEvaluator:
         else:
             self.predictions["tn"].append(image_path)
 
+    def compute_pr_curve(self, gt_boxes, gt_offsets, predictions, pred_offsets):
+        """
+        Computes the precision-recall curve from predictions at the floor confidence, see utils.compute_pr_curve.
+        The curve is sampled to at most PR_CURVE_POINTS thresholds, average precision and best F1 are computed
+        on the full curve. The floor and the configured confidence threshold are always points of the curve,
+        the latter with the metrics returned by evaluate.
+        """
+        curve = compute_pr_curve(
+            gt_boxes,
+            gt_offsets,
+            predictions,
+            pred_offsets,
+            self.iou_threshold,
+            thresholds=[self.inference_params["conf"], self.conf_threshold],
+        )
+        nb_thresholds = len(curve["thresholds"])
+        points = np.unique(
+            np.concatenate(
+                [
+                    np.linspace(0, nb_thresholds - 1, min(nb_thresholds, self.PR_CURVE_POINTS)).astype(np.int64),
+                    np.flatnonzero(curve["thresholds"] == self.conf_threshold),
+                ]
+            )
+        )
+        for key in ["thresholds", "precision", "recall", "f1"]:
+            curve[key] = curve[key][points]
+
+        logging.info(
+            f"Average precision: {curve['average_precision']:.3f}, best F1: {curve['best_f1']:.3f} "
+            f"at confidence {curve['best_f1_threshold']}"
+        )
+        return curve
+
     def evaluate(self):
         """
         Compares predictions and labels to evaluate the model performance on the dataset
@@ -123,19 +397,27 @@ class ModelEvaluator:
         else:
             self.run_predictions()
 
-        nb_fp, nb_tp, nb_fn = 0, 0, 0
-
-        for image in self.images:
-            # Labels
-            gt_boxes = image.boxes_xyxy
-            # Predictions - last element of the array is the confidence
-            pred_boxes = np.array([pred[:-1] for pred in image.prediction])
-            fp, tp, fn = find_matches(gt_boxes, pred_boxes, self.iou_threshold)
+        # Labels and predictions of all images are gathered in ragged arrays and matched at once
+        gt_boxes, gt_offsets = ragged_array([image.boxes_xyxy for image in self.images], 4)
+        # Predictions - last element of each box is the confidence
+        pred_boxes, pred_offsets = ragged_array(
+            [np.asarray(image.prediction, dtype=np.float64).reshape(-1, 5) for image in self.images],
+            5,
+        )
+        pr_curve = None
+        if self.pr_curve:
+            pr_curve = self.compute_pr_curve(gt_boxes, gt_offsets, pred_boxes, pred_offsets)
+            # Predictions below the confidence threshold would not have been returned by the model
+            pred_boxes, pred_offsets = filter_ragged(
+                pred_boxes, pred_offsets, pred_boxes[:, 4] > self.conf_threshold
+            )
+        image_fp, image_tp, image_fn = find_matches_batched(
+            gt_boxes, gt_offsets, pred_boxes[:, :4], pred_offsets, self.iou_threshold
+        )
+        for image, fp, tp, fn in zip(self.images, image_fp, image_tp, image_fn):
             self.track_predictions(fp, tp, fn, image.path)
 
-            nb_fp += fp
-            nb_tp += tp
-            nb_fn += fn
+        nb_fp, nb_tp, nb_fn = image_fp.sum(), image_tp.sum(), image_fn.sum()
         metrics = compute_metrics(
             false_positives=nb_fp, true_positives=nb_tp, false_negatives=nb_fn
         )
@@ -148,4 +430,8 @@ class ModelEvaluator:
             "tp": int(nb_tp),
             "fn": int(nb_fn),
             "predictions": self.predictions,
+            "loader": self.loader_stats,
+            "batch_size": self.batch_size,
+            "session": self.model.session_description,
+            "pr_curve": pr_curve,
         }
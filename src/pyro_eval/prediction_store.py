@@ -0,0 +1,188 @@
+import hashlib
+import json
+import logging
+import os
+import time
+
+import numpy as np
+
+from .utils import compute_file_hash, file_lock, ragged_array
+
+
+class PredictionStore:
+    """
+    Content-addressed store of model predictions, shared across runs and processes.
+    Predictions are stored under a key combining the hash of the model file and the inference parameters, and are
+    indexed by the hash of image contents : a retrained model saved at the same path gets a new key, and images
+    with the same name in different folders do not collide.
+    Predictions are written in immutable segments of three .npy files, readable as memory maps :
+    - hashes : sorted image hashes, the index of the segment
+    - offsets : predictions of image i are rows offsets[i]:offsets[i + 1] of the predictions array
+    - predictions : (N, 5) float64 array of [x1, y1, x2, y2, confidence] predictions
+    When an image is in several segments, the most recent segment is used. compact() merges segments in one once
+    there are enough of them.
+    """
+
+    def __init__(self, store_dir, model_path, inference_params: dict):
+        self.key = self.get_key(model_path, inference_params)
+        self.store_dir = os.path.join(str(store_dir), self.key)
+        os.makedirs(self.store_dir, exist_ok=True)
+        self.lock_path = os.path.join(self.store_dir, "store.lock")
+        self.index = None
+
+    @staticmethod
+    def get_key(model_path, inference_params):
+        description = {
+            "model_hash": compute_file_hash(model_path),
+            "inference_params": inference_params,
+        }
+        return hashlib.sha256(json.dumps(description, sort_keys=True).encode()).hexdigest()
+
+    def get_segment_path(self, segment, array_name):
+        return os.path.join(self.store_dir, f"{segment}.{array_name}.npy")
+
+    def list_segments(self):
+        """
+        Returns the names of complete segments, by writing order : the hashes file is written last
+        """
+        suffix = ".hashes.npy"
+        return sorted(
+            filename[: -len(suffix)]
+            for filename in os.listdir(self.store_dir)
+            if filename.endswith(suffix)
+        )
+
+    def load_index(self):
+        with file_lock(self.lock_path):
+            return self.read_index()
+
+    def read_index(self):
+        """
+        Merges the indexes of all segments : for each image hash, the segment and the row of its predictions.
+        Must be called with the store lock held.
+        """
+        segments = [
+            (
+                np.load(self.get_segment_path(segment, "hashes")),
+                np.load(self.get_segment_path(segment, "offsets"), mmap_mode="r"),
+                np.load(self.get_segment_path(segment, "predictions"), mmap_mode="r"),
+            )
+            for segment in self.list_segments()
+        ]
+        self.index = {
+            "hashes": np.array([], dtype=str),
+            "segment_ids": np.array([], dtype=np.int64),
+            "rows": np.array([], dtype=np.int64),
+            "segments": segments,
+        }
+        if not segments:
+            return self.index
+
+        hashes = np.concatenate([segment_hashes for segment_hashes, _, _ in segments])
+        segment_ids = np.repeat(np.arange(len(segments)), [len(segment_hashes) for segment_hashes, _, _ in segments])
+        rows = np.concatenate([np.arange(len(segment_hashes)) for segment_hashes, _, _ in segments])
+
+        # Images found in several segments keep the last one
+        order = last_occurrences(hashes)
+        self.index.update(hashes=hashes[order], segment_ids=segment_ids[order], rows=rows[order])
+        return self.index
+
+    def get(self, image_hashes):
+        """
+        Returns the predictions of each image hash, None for images not in the store.
+        Images are looked up at once in the sorted index.
+        """
+        index = self.load_index()
+        image_hashes = np.asarray(image_hashes, dtype=str)
+        if len(index["hashes"]) == 0:
+            return [None] * len(image_hashes)
+
+        positions = np.searchsorted(index["hashes"], image_hashes)
+        positions = np.minimum(positions, len(index["hashes"]) - 1)
+        found = index["hashes"][positions] == image_hashes
+
+        predictions = [None] * len(image_hashes)
+        for i in np.flatnonzero(found):
+            _, offsets, segment_predictions = index["segments"][index["segment_ids"][positions[i]]]
+            row = index["rows"][positions[i]]
+            predictions[i] = segment_predictions[offsets[row] : offsets[row + 1]]
+        return predictions
+
+    def add(self, image_hashes, predictions):
+        """
+        Writes the predictions of a list of images in a new segment
+        """
+        image_hashes = np.asarray(image_hashes, dtype=str)
+        if len(image_hashes) == 0:
+            return None
+        # The last prediction of an image is kept, as in a dict
+        order = last_occurrences(image_hashes)
+        prediction_array, offsets = ragged_array(
+            [np.asarray(predictions[i], dtype=np.float64).reshape(-1, 5) for i in order], 5
+        )
+        with file_lock(self.lock_path):
+            return self.write_segment(image_hashes[order], offsets, prediction_array)
+
+    def write_segment(self, hashes, offsets, predictions):
+        """
+        Must be called with the store lock held
+        """
+        # Segment names are ordered by writing time, the process id avoids collisions between processes
+        segment = f"segment-{time.time_ns()}-{os.getpid()}"
+        # The hashes file is written last : a segment is only listed once complete
+        for array_name, array in [("offsets", offsets), ("predictions", predictions), ("hashes", hashes)]:
+            path = self.get_segment_path(segment, array_name)
+            with open(f"{path}.tmp", "wb") as fp:
+                np.save(fp, array)
+            os.replace(f"{path}.tmp", path)
+        logging.info(f"{len(hashes)} image predictions saved in {self.store_dir}")
+        return segment
+
+    def remove_incomplete_segments(self):
+        """
+        Removes the files of segments whose writing was interrupted. Must be called with the store lock held.
+        """
+        segments = set(self.list_segments())
+        for filename in os.listdir(self.store_dir):
+            incomplete = filename.endswith(".tmp") or (
+                filename.startswith("segment-") and filename.split(".")[0] not in segments
+            )
+            if incomplete:
+                logging.info(f"Removing incomplete prediction segment file {filename}")
+                os.remove(os.path.join(self.store_dir, filename))
+
+    def compact(self, min_segments=2):
+        """
+        Merges all segments in a single one if there are at least min_segments segments : lookups read the index
+        of every segment, but merging rewrites all predictions
+        """
+        with file_lock(self.lock_path):
+            self.remove_incomplete_segments()
+            segments = self.list_segments()
+            if len(segments) < max(min_segments, 2):
+                return
+            index = self.read_index()
+            image_predictions = []
+            for segment_id, row in zip(index["segment_ids"], index["rows"]):
+                _, offsets, segment_predictions = index["segments"][segment_id]
+                image_predictions.append(segment_predictions[offsets[row] : offsets[row + 1]])
+            prediction_array, offsets = ragged_array(image_predictions, 5)
+
+            self.write_segment(index["hashes"], offsets, prediction_array)
+            for segment in segments:
+                # The hashes file is removed first, so that the segment is not listed anymore
+                for array_name in ["hashes", "offsets", "predictions"]:
+                    os.remove(self.get_segment_path(segment, array_name))
+        logging.info(f"Merged {len(segments)} prediction segments in {self.store_dir}")
+
+    def __len__(self):
+        return len(self.load_index()["hashes"])
+
+
+def last_occurrences(values: np.ndarray) -> np.ndarray:
+    """
+    Returns the indices of the last occurrence of each distinct value, sorted by value
+    """
+    order = np.argsort(values, kind="stable")
+    sorted_values = values[order]
+    return order[np.append(sorted_values[1:] != sorted_values[:-1], len(order) > 0)[: len(order)]]
@@ -0,0 +1,73 @@
+import numpy as np
+import pandas as pd
+
+from .data_structures import Sequence, object_array
+
+
+class ResultBuffer:
+    """
+    Per-frame engine results stored in preallocated typed columns, filled sequence by sequence.
+    The results dataframe is built once from the columns, instead of growing a dataframe frame by frame.
+    """
+
+    COLUMNS = {
+        "sequence_id": object,
+        "image": object,
+        "sequence_label": bool,
+        "ground_truth_boxes": object,
+        "image_label": bool,
+        "prediction": bool,
+        "confidence": np.float64,
+        "timedelta": "timedelta64[ns]",
+    }
+
+    def __init__(self, capacity: int):
+        self.columns = {
+            name: np.empty(capacity, dtype=dtype) for name, dtype in self.COLUMNS.items()
+        }
+        self.size = 0
+
+    def add_sequence(self, sequence: Sequence, confidences: np.ndarray, conf_thresh: float):
+        """
+        Adds the results of a sequence, confidences are the engine outputs of its images in order
+        """
+        images = sequence.images
+        if len(confidences) != len(images):
+            raise ValueError(
+                f"{len(confidences)} confidences for the {len(images)} images of {sequence}"
+            )
+        end = self.size + len(images)
+        if end > len(self.columns["confidence"]):
+            self.grow(end)
+
+        rows = slice(self.size, end)
+        confidences = np.asarray(confidences, dtype=np.float64)
+        self.columns["sequence_id"][rows] = sequence.sequence_id
+        # Paths are stored as str, as they are read back from the checkpoint log when a run is resumed
+        self.columns["image"][rows] = object_array([str(image.path) for image in images])
+        self.columns["sequence_label"][rows] = sequence.label
+        self.columns["ground_truth_boxes"][rows] = object_array([image.boxes for image in images])
+        self.columns["image_label"][rows] = [image.label for image in images]
+        self.columns["prediction"][rows] = confidences > conf_thresh
+        self.columns["confidence"][rows] = confidences
+        self.columns["timedelta"][rows] = pd.to_timedelta(
+            [image.timedelta for image in images]
+        ).to_numpy()
+        self.size = end
+
+    def grow(self, size: int):
+        capacity = max(size, 2 * len(self.columns["confidence"]))
+        for name, column in self.columns.items():
+            grown = np.empty(capacity, dtype=column.dtype)
+            grown[: self.size] = column[: self.size]
+            self.columns[name] = grown
+
+    def get_columns(self, start: int = 0, stop: int = None) -> dict:
+        stop = self.size if stop is None else stop
+        return {name: column[start:stop] for name, column in self.columns.items()}
+
+    def to_dataframe(self, start: int = 0, stop: int = None) -> pd.DataFrame:
+        return pd.DataFrame(self.get_columns(start, stop))
+
+    def __len__(self):
+        return self.size
@@ -1,11 +1,16 @@
+import fcntl
+import hashlib
 import os
 import random
 import re
+from contextlib import contextmanager
 from datetime import datetime
+from functools import lru_cache
 from pathlib import PosixPath
 import matplotlib.pyplot as plt
 import numpy as np
 from pandas import Timedelta
+from PIL import Image as PILImage
 from ultralytics import YOLO
 
 EXTENSIONS = [".jpg", ".png", ".tif", ".jpeg", ".tiff"]
@@ -19,33 +24,133 @@ def has_image_extension(image_path):
     return os.path.splitext(image_path)[-1].lower() in EXTENSIONS
 
 
-def parse_date_from_filepath(filepath):
-    """Extracts date from filename, typcally : pyronear_sdis-07_brison-200_2024-01-26t11-13-37.jpg"""
+def reduce_image(image: PILImage.Image, target_size) -> PILImage.Image:
+    """
+    Downscales an image so that its longest side is target_size, keeping its aspect ratio.
+    JPEG images are decoded directly at a reduced scale with draft() (DCT scaling by 1/2, 1/4 or 1/8, the
+    largest reduction that keeps the image above target_size), then resized.
+    Images already smaller than target_size are returned unchanged.
+    target_size can be an int or a (height, width) tuple, in which case its longest side is used.
+    """
+    if target_size is None:
+        return image
+    if not isinstance(target_size, (int, float)):
+        target_size = max(target_size)
+
+    scale = target_size / max(image.size)
+    if scale >= 1:
+        return image
+
+    size = (max(1, round(image.width * scale)), max(1, round(image.height * scale)))
+    if image.format == "JPEG":
+        # Only has an effect if the image has not been decoded yet
+        image.draft(image.mode, size)
+    return image.resize(size, PILImage.BILINEAR)
+
+
+def compute_file_hash(filepath, chunk_size=1 << 20):
+    """
+    Computes the md5 hash of a file, read by chunks to keep memory usage low
+    """
+    hash_md5 = hashlib.md5()
+    with open(filepath, "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            hash_md5.update(chunk)
+    return hash_md5.hexdigest()
+
 
-    filename = os.path.basename(filepath)
-    prefix, file_datetime = None, None
+def is_arrow_dataset(datapath):
+    """
+    Checks whether a local path is a copy of a hugging face dataset : parquet file(s) or a folder
+    created with save_to_disk, as opposed to an image folder
+    """
+    datapath = str(datapath)
+    if os.path.isfile(datapath):
+        return datapath.endswith(".parquet")
+    if os.path.isdir(os.path.join(datapath, "images")):
+        return False
+    return any(
+        os.path.isfile(os.path.join(datapath, filename))
+        for filename in ["dataset_info.json", "state.json", "dataset_dict.json"]
+    ) or any(PosixPath(datapath).glob("**/*.parquet"))
+
+
+def compute_source_stats(datapath):
+    """
+    Stats of the files a local dataset is built from : their paths relative to the dataset, sorted, and an
+    int64 array of their size, modification time (ns) and inode. Files are listed and stat'ed, not read.
+    Image folders are described by their images and labels subfolders, hugging face copies by their parquet
+    and arrow files. Returns None for remote datasets.
+    """
+    datapath = str(datapath)
+    if os.path.isfile(datapath):
+        root = os.path.dirname(datapath)
+        filepaths = [datapath]
+    elif os.path.isdir(os.path.join(datapath, "images")):
+        root = datapath
+        filepaths = [
+            os.path.join(folder_root, filename)
+            for folder in ["images", "labels"]
+            for folder_root, _, filenames in os.walk(os.path.join(datapath, folder))
+            for filename in filenames
+        ]
+    elif os.path.isdir(datapath):
+        root = datapath
+        filepaths = [
+            os.path.join(folder_root, filename)
+            for folder_root, _, filenames in os.walk(datapath)
+            for filename in filenames
+            if filename.endswith((".parquet", ".arrow"))
+        ]
+    else:
+        return None
 
-    pattern = r"_(\d{4})_(\d{2})_(\d{2})t(\d{2})_(\d{2})_(\d{2})\.(jpg|png)$"
+    filepaths = sorted(filepaths)
+    stats = np.zeros((len(filepaths), 3), dtype=np.int64)
+    for i, filepath in enumerate(filepaths):
+        stat = os.stat(filepath)
+        stats[i] = [stat.st_size, stat.st_mtime_ns, stat.st_ino]
+    return [os.path.relpath(filepath, root) for filepath in filepaths], stats
 
-    # Search for the pattern in the filename
-    match = re.search(pattern, filename.lower())
 
-    if not match:
-        pattern = r"_(\d{4})-(\d{2})-(\d{2})t(\d{2})-(\d{2})-(\d{2})\.(jpg|png)$"
-        match = re.search(pattern, filename.lower())
+# Filename date formats, typically : pyronear_sdis-07_brison-200_2024-01-26t11-13-37.jpg
+DATE_PATTERNS = [
+    re.compile(r"_(\d{4})_(\d{2})_(\d{2})t(\d{2})_(\d{2})_(\d{2})\.(jpg|png)$"),
+    re.compile(r"_(\d{4})-(\d{2})-(\d{2})t(\d{2})-(\d{2})-(\d{2})\.(jpg|png)$"),
+]
 
-    if match:
-        # Extract components
-        prefix = filename[: match.start()]
-        year = int(match.group(1))
-        month = int(match.group(2))
-        day = int(match.group(3))
-        hour = int(match.group(4))
-        minute = int(match.group(5))
-        second = int(match.group(6))
 
-        # Create datetime object
-        file_datetime = datetime(year, month, day, hour, minute, second)
+@lru_cache(maxsize=1 << 20)
+def parse_date_from_filename(filename):
+    """
+    Extracts prefix and date from a filename, returns (None, None) if the filename doesn't match.
+    Results are memoized as the same files are parsed by several components.
+    """
+    lower_filename = filename.lower()
+    for pattern in DATE_PATTERNS:
+        # Search for the pattern in the filename
+        match = pattern.search(lower_filename)
+        if match:
+            # Extract components and create datetime object
+            year, month, day, hour, minute, second = map(int, match.groups()[:6])
+            return filename[: match.start()], datetime(
+                year, month, day, hour, minute, second
+            )
+
+    return None, None
+
+
+def combine_hashes(hashes):
+    """
+    Combines an ordered iterable of hashes into a single sha256 hash
+    """
+    return hashlib.sha256("".join(hashes).encode("utf-8")).hexdigest()
+
+
+def parse_date_from_filepath(filepath):
+    """Extracts date from filename, typcally : pyronear_sdis-07_brison-200_2024-01-26t11-13-37.jpg"""
+
+    prefix, file_datetime = parse_date_from_filename(os.path.basename(filepath))
 
     return {
         "prefix": prefix,
@@ -53,6 +158,32 @@ def parse_date_from_filepath(filepath):
     }
 
 
+def parse_dates_from_filepaths(filepaths):
+    """
+    Parses a list of filepaths at once, each filename is parsed a single time.
+    Returns an object array of prefixes and a datetime64 array of dates, NaT where no date was found.
+    """
+    parsed = [parse_date_from_filename(os.path.basename(filepath)) for filepath in filepaths]
+    prefixes = np.array([prefix for prefix, _ in parsed], dtype=object)
+    dates = np.array([date for _, date in parsed], dtype="datetime64[s]")
+    return prefixes, dates
+
+
+def encode_strings(values):
+    """
+    Encodes an iterable of strings (or paths) as a fixed-width utf-8 bytes numpy array,
+    which can be saved without pickling
+    """
+    return np.array([str(value).encode("utf-8") for value in values], dtype=bytes)
+
+
+def decode_strings(array):
+    """
+    Decodes a bytes numpy array created with encode_strings into a list of str
+    """
+    return [value.decode("utf-8") for value in array]
+
+
 def make_dict_json_compatible(data):
     """
     Replaces values to be able dump a dict in a json:
@@ -153,48 +284,185 @@ def box_iou(box1: np.ndarray, box2: np.ndarray, eps: float = 1e-7):
     return inter / ((a2 - a1).prod(1) + (b2 - b1).prod(1)[:, None] - inter + eps)
 
 
+def paired_box_iou(box1: np.ndarray, box2: np.ndarray, eps: float = 1e-7):
+    """
+    Calculate the intersection-over-union (IoU) of box1[i] and box2[i] for each i, boxes in (x1, y1, x2, y2) format.
+    Same computation as box_iou, on pairs of boxes instead of all combinations.
+
+    Args:
+        box1 (np.ndarray): A numpy array of shape (N, 4)
+        box2 (np.ndarray): A numpy array of shape (N, 4)
+
+    Returns:
+        (np.ndarray): An array of N IoU values
+    """
+    (a1, a2), (b1, b2) = np.split(box1, 2, 1), np.split(box2, 2, 1)
+    inter = (np.minimum(a2, b2) - np.maximum(a1, b1)).clip(0).prod(1)
+    return inter / ((a2 - a1).prod(1) + (b2 - b1).prod(1) - inter + eps)
+
+
 def find_matches(gt_boxes, pred_boxes, iou):
     """
     Given a list of ground truth boxes, predicted boxes and a threshold iou, computes matches and
     returns the number of true positives, false positives and false negatives.
+    A prediction is a true positive if it overlaps at least one ground truth box, a ground truth box
+    is a false negative if no prediction overlaps it.
     """
-    nb_fp, nb_tp, nb_fn = 0, 0, 0
-    gt_matches = np.zeros(len(gt_boxes), dtype=bool)
+    gt_boxes = np.asarray(gt_boxes).reshape(-1, 4)
+    pred_boxes = np.asarray(pred_boxes).reshape(-1, 4)
+    if len(gt_boxes) == 0 or len(pred_boxes) == 0:
+        return (len(pred_boxes), 0, len(gt_boxes))
 
-    # For each prediciton, we check whether we find one or several overlapping ground truth box
-    for pred_box in pred_boxes:
-        if gt_boxes:
-            # Compute matches
-            matches = np.array(
-                [box_iou(pred_box, gt_box) > iou for gt_box in gt_boxes], dtype=bool
-            )
+    # (P, G) matrix of matches between predictions and ground truth boxes
+    matches = box_iou(gt_boxes, pred_boxes) > iou
+    nb_tp = int(matches.any(1).sum())
+    nb_fn = len(gt_boxes) - int(matches.any(0).sum())
 
-            # Check if any match exists
-            if matches.any():
-                nb_tp += 1
-                matches = matches.reshape(gt_matches.shape)
-                # Logical OR operation in order to update gt_matches with new matches (new True value in the array)
-                gt_matches = np.logical_or(gt_matches, matches)
-            else:
-                nb_fp += 1
-        else:
-            nb_fp += 1
+    return (len(pred_boxes) - nb_tp, nb_tp, nb_fn)
+
+
+def ragged_array(arrays, width):
+    """
+    Concatenates a list of (K_i, width) arrays in a single array, rows offsets[i]:offsets[i + 1] come from array i
+    """
+    counts = [len(array) for array in arrays]
+    offsets = np.zeros(len(arrays) + 1, dtype=np.int64)
+    np.cumsum(counts, out=offsets[1:])
+    if not arrays:
+        return np.empty((0, width)), offsets
+    return np.concatenate([np.reshape(array, (-1, width)) for array in arrays]), offsets
+
+
+def match_boxes_batched(gt_boxes, gt_offsets, pred_boxes, pred_offsets, iou):
+    """
+    Finds overlapping predictions and ground truth boxes for a list of images at once.
+    Boxes are ragged arrays : gt_boxes is a (G, 4) array where rows gt_offsets[i]:gt_offsets[i + 1] are the ground
+    truth boxes of image i, and likewise for the (P, 4) pred_boxes array.
+    Returns the prediction and ground truth indices of the pairs of boxes of the same image with an IoU above iou.
+    """
+    gt_boxes = np.asarray(gt_boxes).reshape(-1, 4)
+    pred_boxes = np.asarray(pred_boxes).reshape(-1, 4)
+    gt_counts = np.diff(gt_offsets)
+    pred_counts = np.diff(pred_offsets)
+
+    # Each prediction is paired with every ground truth box of its image
+    pred_images = np.repeat(np.arange(len(pred_counts)), pred_counts)
+    pairs_per_pred = gt_counts[pred_images]
+    pair_preds = np.repeat(np.arange(len(pred_boxes)), pairs_per_pred)
+    pair_starts = np.cumsum(pairs_per_pred) - pairs_per_pred
+    pair_gts = (
+        np.repeat(gt_offsets[:-1][pred_images] - pair_starts, pairs_per_pred)
+        + np.arange(len(pair_preds))
+    )
+
+    matches = paired_box_iou(pred_boxes[pair_preds], gt_boxes[pair_gts]) > iou
+    return pair_preds[matches], pair_gts[matches]
+
+
+def find_matches_batched(gt_boxes, gt_offsets, pred_boxes, pred_offsets, iou):
+    """
+    Computes matches as find_matches for a list of images at once, boxes are ragged arrays (see match_boxes_batched).
+    Returns the number of false positives, true positives and false negatives of each image, as arrays.
+    """
+    gt_counts = np.diff(gt_offsets)
+    pred_counts = np.diff(pred_offsets)
+    nb_images = len(gt_counts)
+    match_preds, match_gts = match_boxes_batched(gt_boxes, gt_offsets, pred_boxes, pred_offsets, iou)
+    pred_matched = np.bincount(match_preds, minlength=pred_offsets[-1]) > 0
+    gt_matched = np.bincount(match_gts, minlength=gt_offsets[-1]) > 0
+
+    pred_images = np.repeat(np.arange(nb_images), pred_counts)
+    gt_images = np.repeat(np.arange(nb_images), gt_counts)
+    nb_tp = np.bincount(pred_images[pred_matched], minlength=nb_images)
+    nb_fn = gt_counts - np.bincount(gt_images[gt_matched], minlength=nb_images)
 
-    if gt_boxes:
-        nb_fn += len(gt_boxes) - np.sum(gt_matches)
+    return pred_counts - nb_tp, nb_tp, nb_fn
 
-    return (nb_fp, nb_tp, nb_fn)
+
+def filter_ragged(array, offsets, mask):
+    """
+    Keeps the rows of a ragged array (see ragged_array) where mask is True, returns the new array and offsets
+    """
+    kept_before = np.zeros(len(mask) + 1, dtype=np.int64)
+    np.cumsum(mask, out=kept_before[1:])
+    return array[mask], kept_before[offsets]
+
+
+def compute_pr_curve(gt_boxes, gt_offsets, predictions, pred_offsets, iou, thresholds=()):
+    """
+    Computes precision, recall and F1 at every confidence threshold from a single matching pass.
+    predictions is a ragged (P, 5) array of [x1, y1, x2, y2, confidence] predictions, matched to ground truth boxes
+    as in find_matches. At threshold t, predictions with a confidence > t are kept, as when the model filters its
+    predictions with conf = t : a kept prediction is a true positive if it overlaps a ground truth box, and a ground
+    truth box is a false negative if no kept prediction overlaps it, i.e. if the best confidence of its overlapping
+    predictions is not above t.
+    The curve is computed at the distinct confidences of the predictions and at the given thresholds.
+    Returns the curve by decreasing threshold, the average precision and the threshold with the best F1.
+    """
+    confidences = predictions[:, 4]
+    match_preds, match_gts = match_boxes_batched(
+        gt_boxes, gt_offsets, predictions[:, :4], pred_offsets, iou
+    )
+    pred_matched = np.bincount(match_preds, minlength=len(predictions)) > 0
+    gt_best_confidences = np.full(gt_offsets[-1], -np.inf)
+    np.maximum.at(gt_best_confidences, match_gts, confidences[match_preds])
+
+    # Counts of predictions above each threshold, by decreasing threshold
+    thresholds = np.unique(np.concatenate([confidences, np.asarray(thresholds, dtype=np.float64)]))[::-1]
+    nb_kept = len(confidences) - np.searchsorted(np.sort(confidences), thresholds, side="right")
+    matched_confidences = np.sort(confidences[pred_matched])
+    tp = len(matched_confidences) - np.searchsorted(matched_confidences, thresholds, side="right")
+    fp = nb_kept - tp
+    fn = np.searchsorted(np.sort(gt_best_confidences), thresholds, side="right")
+
+    # Same definitions as compute_metrics
+    with np.errstate(divide="ignore", invalid="ignore"):
+        precision = np.where(tp + fp > 0, tp / (tp + fp), 0.0)
+        recall = np.where(tp + fn > 0, tp / (tp + fn), 0.0)
+        f1 = np.where(
+            precision + recall > 0, 2 * precision * recall / (precision + recall), 0.0
+        )
+
+    # All-point interpolated average precision : precision is made non-increasing with recall
+    interpolated_precision = np.maximum.accumulate(precision[::-1])[::-1]
+    average_precision = float(np.sum(np.diff(recall, prepend=0.0) * interpolated_precision))
+    best = int(np.argmax(f1)) if len(f1) else None
+
+    return {
+        "thresholds": thresholds,
+        "precision": precision,
+        "recall": recall,
+        "f1": f1,
+        "average_precision": average_precision,
+        "best_f1": float(f1[best]) if best is not None else 0.0,
+        "best_f1_threshold": float(thresholds[best]) if best is not None else None,
+    }
+
+
+@contextmanager
+def file_lock(lock_path):
+    """
+    Exclusive lock on a file, shared between processes
+    """
+    with open(lock_path, "w") as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
 
 
-def export_model(model_path: str):
+def export_model(model_path: str, **export_args):
     """
     Engine needs an onnx model to be instanciated, this methods creates a .onnx file from the .pt path
+    export_args are passed to the ultralytics export, the model is exported with a dynamic input size by default
     """
     # Load .pt model and export
     model = YOLO(model_path)
 
     # Export to onnx format
-    onnx_path = model.export(format="onnx", dynamic=True)
+    export_args.setdefault("dynamic", True)
+    onnx_path = model.export(format="onnx", **export_args)
     if not os.path.isfile(onnx_path):
         raise RuntimeError("Failed to export the model to onnx format.")
 
@@ -0,0 +1,151 @@
+import random
+from collections import deque
+from datetime import datetime, timedelta
+
+import numpy as np
+import pytest
+from PIL import Image
+
+import pyro_eval.engine_evaluation
+import pyro_eval.model
+from pyro_eval.utils import box_iou
+
+
+def make_image_folder(root, cameras=("cam-a_site-1", "cam-b_site-2", "cam-c_site-3"), nb_images=12, seed=0):
+    """
+    Creates an image folder dataset : images of several cameras, taken 1 to 45 minutes apart so that cameras
+    have several sequences, half of them with a label file
+    """
+    rng = random.Random(seed)
+    (root / "images").mkdir(parents=True)
+    (root / "labels").mkdir(parents=True)
+    for camera in cameras:
+        date = datetime(2024, 1, 1, 10, 0, 0)
+        for i in range(nb_images):
+            date += timedelta(minutes=rng.choice([1, 2, 45]))
+            name = f"{camera}_{date.strftime('%Y-%m-%dT%H-%M-%S')}"
+            color = tuple(rng.randint(0, 255) for _ in range(3))
+            Image.new("RGB", (64 + i, 48), color).save(root / "images" / f"{name}.jpg")
+            if rng.random() < 0.5:
+                (root / "labels" / f"{name}.txt").write_text(f"0 0.5 0.5 0.{i + 1} 0.2\n")
+    return root
+
+
+@pytest.fixture
+def image_folder(tmp_path):
+    return make_image_folder(tmp_path / "dataset")
+
+
+def nms(boxes: np.ndarray, overlap_thresh: float = 0) -> np.ndarray:
+    """
+    Non maximum suppression of pyroengine
+    """
+    boxes = boxes[boxes[:, -1].argsort()]
+    indices = np.arange(len(boxes))
+    ious = box_iou(boxes[:, :4], boxes[:, :4])
+    for i in range(len(boxes)):
+        temp_indices = indices[indices != i]
+        if np.any(ious[i, temp_indices] > overlap_thresh):
+            indices = indices[indices != i]
+    return boxes[indices]
+
+
+class StubClassifier:
+    """
+    Classifier with the interface and the filters of the pyroengine Classifier, whose raw detections are
+    computed from the mean color of the frame instead of an onnx model
+    """
+
+    def __init__(self, model_path=None, format="onnx", conf=0.15, max_bbox_size=0.4, imgsz=32):
+        self.model_path = model_path
+        self.conf = conf
+        self.max_bbox_size = max_bbox_size
+        self.imgsz = imgsz
+
+    def __call__(self, pil_img):
+        red, green, blue = np.asarray(pil_img.convert("RGB"), dtype=np.float64).reshape(-1, 3).mean(0) / 255
+        pred = np.array(
+            [
+                [0.1, 0.1, 0.3, 0.3, red],
+                [0.12, 0.1, 0.32, 0.32, green],
+                [0.6, 0.5, 0.7, 0.6, blue / 4],
+                [0.0, 0.0, 0.9, 0.9, (red + green) / 2],  # Wider than max_bbox_size
+                [0.95, 0.9, 1.1, 1.0, blue],  # Clipped
+            ]
+        )
+        pred = nms(pred[pred[:, 4] > self.conf])[::-1]
+        pred = np.clip(pred, 0, 1)
+        pred = pred[(pred[:, 2] - pred[:, 0]) < self.max_bbox_size, :]
+        return np.reshape(pred, (-1, 5))
+
+
+class StubEngine:
+    """
+    Engine running a StubClassifier on each frame, with the state update of the pyroengine Engine
+    """
+
+    def __init__(self, nb_consecutive_frames=4, conf_thresh=0.15, max_bbox_size=0.4, model_path=None):
+        self.nb_consecutive_frames = nb_consecutive_frames
+        self.conf_thresh = conf_thresh
+        self.model = StubClassifier(model_path, conf=0.05, max_bbox_size=max_bbox_size)
+        self._states = {
+            "-1": {"last_predictions": deque([], self.nb_consecutive_frames), "ongoing": False},
+        }
+
+    def predict(self, frame, cam_id=None):
+        cam_key = cam_id or "-1"
+        preds = self.model(frame.convert("RGB"))
+        return self._update_states(preds, cam_key)
+
+    def _update_states(self, preds, cam_key):
+        conf_th = self.conf_thresh * self.nb_consecutive_frames
+        # Reduce threshold once we are in alert mode to collect more data
+        if self._states[cam_key]["ongoing"]:
+            conf_th *= 0.8
+
+        boxes = np.zeros((0, 5))
+        boxes = np.concatenate([boxes, preds])
+        for box in self._states[cam_key]["last_predictions"]:
+            if box.shape[0] > 0:
+                boxes = np.concatenate([boxes, box])
+
+        conf = 0
+        if boxes.shape[0]:
+            best_boxes = nms(boxes)
+            detections = boxes[boxes[:, -1] > self.conf_thresh, :]
+            ious_detections = box_iou(best_boxes[:, :4], detections[:, :4])
+            strong_detection = np.sum(ious_detections > 0, 0) > 1
+            best_boxes = best_boxes[strong_detection, :]
+            if best_boxes.shape[0]:
+                ious = box_iou(best_boxes[:, :4], boxes[:, :4])
+                best_boxes_scores = np.array([sum(boxes[iou > 0, 4]) for iou in ious.T])
+                # Boxes of the alert, selected with conf_th
+                self.alert_boxes = best_boxes[best_boxes_scores > conf_th, :]
+                conf = np.max(best_boxes_scores) / (self.nb_consecutive_frames + 1)
+
+        self._states[cam_key]["last_predictions"].append(preds)
+        self._states[cam_key]["ongoing"] = conf > self.conf_thresh
+        return float(conf)
+
+
+@pytest.fixture
+def stub_engine(tmp_path, monkeypatch):
+    """
+    Replaces the pyroengine Engine and Classifier by stubs, returns the path of a placeholder onnx model
+    """
+    monkeypatch.setattr(pyro_eval.engine_evaluation, "Engine", StubEngine)
+    monkeypatch.setattr(pyro_eval.model, "Classifier", StubClassifier)
+    model_path = tmp_path / "model.onnx"
+    model_path.write_bytes(b"onnx model")
+    return str(model_path)
+
+
+@pytest.fixture
+def engine_config(tmp_path, stub_engine):
+    return {
+        "model_path": stub_engine,
+        "nb_consecutive_frames": 4,
+        "conf_thresh": 0.15,
+        "max_bbox_size": 0.4,
+        "prediction_store": str(tmp_path / "predictions"),
+    }
@@ -0,0 +1,45 @@
+import os
+
+from pyro_eval.dataset import EvaluationDataset
+
+
+def build_snapshot(image_folder):
+    dataset = EvaluationDataset(image_folder)
+    snapshot_path = image_folder / "dataset.snapshot.npz"
+    dataset.save_snapshot(snapshot_path)
+    return snapshot_path
+
+
+def test_snapshot_matches_unchanged_dataset(image_folder):
+    snapshot_path = build_snapshot(image_folder)
+    assert EvaluationDataset.get_snapshot_mismatch(snapshot_path, image_folder) is None
+
+
+def test_snapshot_detects_content_edit(image_folder):
+    snapshot_path = build_snapshot(image_folder)
+    image_path = sorted((image_folder / "images").iterdir())[0]
+    image_path.write_bytes(image_path.read_bytes()[:-16] + bytes(16))
+    # Same number of files and size, restored with an older modification time : the latest one is unchanged
+    os.utime(image_path, ns=(0, 10**9))
+    assert EvaluationDataset.get_snapshot_mismatch(snapshot_path, image_folder) is not None
+
+
+def test_snapshot_detects_rename(image_folder):
+    snapshot_path = build_snapshot(image_folder)
+    label_path = sorted((image_folder / "labels").iterdir())[0]
+    label_path.rename(label_path.with_name(f"other_{label_path.name}"))
+    assert EvaluationDataset.get_snapshot_mismatch(snapshot_path, image_folder) is not None
+
+
+def test_snapshot_ignores_touched_image(image_folder):
+    snapshot_path = build_snapshot(image_folder)
+    image_path = sorted((image_folder / "images").iterdir())[0]
+    os.utime(image_path, ns=(0, os.stat(image_path).st_mtime_ns + 10**9))
+    assert EvaluationDataset.get_snapshot_mismatch(snapshot_path, image_folder) is None
+
+
+def test_snapshot_detects_label_edit(image_folder):
+    snapshot_path = build_snapshot(image_folder)
+    label_path = sorted((image_folder / "labels").iterdir())[0]
+    label_path.write_text("0 0.1 0.1 0.1 0.1\n")
+    assert EvaluationDataset.get_snapshot_mismatch(snapshot_path, image_folder) is not None
@@ -0,0 +1,63 @@
+import pandas as pd
+
+from pyro_eval.dataset import EvaluationDataset
+from pyro_eval.engine_evaluation import EngineEvaluator
+from pyro_eval.utils import compute_metrics
+
+
+def reference_sequence_metrics(predictions_df):
+    """
+    Sequence metrics computed group by group
+    """
+    rows = []
+    for sequence_id, group in predictions_df.groupby("sequence_id"):
+        detection_timedeltas = pd.to_timedelta(group[group["prediction"]]["timedelta"], errors="coerce")
+        rows.append(
+            {
+                "sequence_id": sequence_id,
+                "label": group["sequence_label"].iloc[0],
+                "has_detection": group["prediction"].any(),
+                "detection_delay": detection_timedeltas.min() if not detection_timedeltas.empty else None,
+            }
+        )
+    sequence_df = pd.DataFrame(rows)
+    label, has_detection = sequence_df["label"] == True, sequence_df["has_detection"] == True
+    sequences = {
+        "tp": sequence_df[label & has_detection],
+        "fn": sequence_df[label & ~has_detection],
+        "fp": sequence_df[~label & has_detection],
+        "tn": sequence_df[~label & ~has_detection],
+    }
+    metrics = compute_metrics(
+        false_positives=len(sequences["fp"]),
+        true_positives=len(sequences["tp"]),
+        false_negatives=len(sequences["fn"]),
+    )
+    tp_delays = sequences["tp"]["detection_delay"]
+    return {
+        "precision": metrics["precision"],
+        "recall": metrics["recall"],
+        "f1": metrics["f1"],
+        **{key: len(value) for key, value in sequences.items()},
+        "avg_detection_delay": tp_delays.dropna().mean() if not tp_delays.isnull().all() else None,
+        "predictions": {key: value["sequence_id"].to_list() for key, value in sequences.items()},
+    }
+
+
+def test_sequence_metrics_match_reference(image_folder, engine_config):
+    evaluator = EngineEvaluator(EvaluationDataset(image_folder), engine_config)
+    evaluator.run_engine_dataset()
+    predictions_df = evaluator.predictions_df
+    # Labels of every other sequence are flipped to get all outcomes, then no sequence has a detection
+    flipped = predictions_df["sequence_id"].isin(predictions_df["sequence_id"].unique()[::2])
+    variants = [
+        predictions_df,
+        predictions_df.assign(sequence_label=predictions_df["sequence_label"] ^ flipped),
+        predictions_df.assign(prediction=False),
+    ]
+
+    for variant in variants:
+        evaluator.predictions_df = variant
+        assert evaluator.compute_sequence_level_metrics() == reference_sequence_metrics(variant)
+    assert all(reference_sequence_metrics(variants[1])[key] > 0 for key in ["tp", "fp", "fn", "tn"])
+    assert reference_sequence_metrics(variants[2])["avg_detection_delay"] is None
@@ -0,0 +1,46 @@
+import multiprocessing
+from types import SimpleNamespace
+
+import pandas as pd
+
+import pyro_eval.engine_evaluation
+from pyro_eval.dataset import EvaluationDataset
+from pyro_eval.engine_evaluation import EngineEvaluator
+
+
+def run_engine(image_folder, config):
+    evaluator = EngineEvaluator(EvaluationDataset(image_folder), config)
+    evaluator.run_engine_dataset()
+    return evaluator
+
+
+def test_parallel_run_matches_serial_run(image_folder, engine_config, tmp_path, monkeypatch):
+    # Forked workers inherit the stub engine, spawned workers would import pyroengine
+    monkeypatch.setattr(
+        pyro_eval.engine_evaluation,
+        "multiprocessing",
+        SimpleNamespace(get_context=lambda method: multiprocessing.get_context("fork")),
+    )
+    serial_run = run_engine(image_folder, engine_config)
+    parallel_run = run_engine(image_folder, {**engine_config, "num_workers": 3})
+    # Each worker creates its own frame cache
+    cached_parallel_run = run_engine(
+        image_folder, {**engine_config, "num_workers": 3, "frame_cache": str(tmp_path / "frames")}
+    )
+
+    assert len(parallel_run.dataset.sequences) > 3
+    assert serial_run.predictions_df["prediction"].any()
+    pd.testing.assert_frame_equal(parallel_run.predictions_df, serial_run.predictions_df)
+    pd.testing.assert_frame_equal(cached_parallel_run.predictions_df, serial_run.predictions_df)
+
+
+def test_cached_frames_match_decoded_frames(image_folder, engine_config, tmp_path):
+    uncached_run = run_engine(image_folder, engine_config)
+    cached_config = {**engine_config, "frame_cache": str(tmp_path / "frames")}
+    # The first run fills the frame cache, the second one reads from it
+    filling_run = run_engine(image_folder, cached_config)
+    cached_run = run_engine(image_folder, cached_config)
+
+    assert cached_run.loader_stats["nb_cached_frames"] == len(cached_run.dataset.get_all_images())
+    pd.testing.assert_frame_equal(filling_run.predictions_df, uncached_run.predictions_df)
+    pd.testing.assert_frame_equal(cached_run.predictions_df, uncached_run.predictions_df)
@@ -0,0 +1,31 @@
+import pandas as pd
+
+from pyro_eval.dataset import EvaluationDataset
+from pyro_eval.engine_evaluation import EngineEvaluator
+
+
+def test_replay_matches_engine(image_folder, engine_config):
+    engine_evaluator = EngineEvaluator(EvaluationDataset(image_folder), engine_config)
+    engine_metrics = engine_evaluator.evaluate()
+
+    replay_evaluator = EngineEvaluator(EvaluationDataset(image_folder), {**engine_config, "replay": True})
+    replay_metrics = replay_evaluator.evaluate()
+
+    assert engine_metrics["mode"] == "engine"
+    assert replay_metrics["mode"] == "replay"
+    # Detections are replayed at the threshold of the engine classifier, on frames decoded at the same size
+    assert replay_metrics["replay"]["model_conf_thresh"] == engine_evaluator.engine.model.conf
+    assert replay_metrics["replay"]["input_size"] == replay_metrics["replay"]["engine_input_size"]
+    # The engine raised alerts, the state logic is exercised
+    assert engine_evaluator.predictions_df["prediction"].any()
+    assert not engine_evaluator.predictions_df["prediction"].all()
+    pd.testing.assert_frame_equal(replay_evaluator.predictions_df, engine_evaluator.predictions_df)
+
+
+def test_replay_threshold_override(image_folder, engine_config):
+    replay_evaluator = EngineEvaluator(
+        EvaluationDataset(image_folder), {**engine_config, "replay": True, "model_conf_thresh": 0.3}
+    )
+    assert replay_evaluator.replay.model_conf_thresh == 0.3
+    # The live classifier keeps its own threshold
+    assert replay_evaluator.engine.model.conf == 0.05
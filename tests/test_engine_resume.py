@@ -0,0 +1,28 @@
+import pandas as pd
+
+import pyro_eval.engine_evaluation
+from pyro_eval.dataset import EvaluationDataset
+from pyro_eval.engine_evaluation import EngineEvaluator
+
+
+def test_resumed_run_matches_full_run(image_folder, engine_config, tmp_path, monkeypatch):
+    # Results are saved next to the module, they are redirected to the test directory
+    monkeypatch.setattr(pyro_eval.engine_evaluation, "__file__", str(tmp_path / "engine_evaluation.py"))
+    full_run = EngineEvaluator(EvaluationDataset(image_folder), engine_config)
+    full_run.run_engine_dataset()
+
+    interrupted_run = EngineEvaluator(EvaluationDataset(image_folder), engine_config, save=True, run_id="resume")
+    interrupted_run.run_engine_dataset()
+    # Only the first sequences were logged before the interruption
+    checkpoint_path = interrupted_run.checkpoint_log.path
+    with open(checkpoint_path) as fp:
+        records = fp.readlines()
+    assert len(records) == len(interrupted_run.dataset.sequences) > 2
+    with open(checkpoint_path, "w") as fp:
+        fp.writelines(records[:2])
+
+    resumed_run = EngineEvaluator(EvaluationDataset(image_folder), engine_config, save=True, run_id="resume")
+    resumed_run.run_engine_dataset()
+
+    assert resumed_run.predictions_df["image"].map(type).eq(str).all()
+    pd.testing.assert_frame_equal(resumed_run.predictions_df, full_run.predictions_df)
@@ -0,0 +1,48 @@
+import pyro_eval.model_evaluation
+from pyro_eval.dataset import EvaluationDataset
+from pyro_eval.model_evaluation import ModelEvaluator
+
+
+def test_stored_predictions_skip_batch_tuning(image_folder, stub_engine, tmp_path, monkeypatch):
+    config = {"model_path": stub_engine, "prediction_store": str(tmp_path / "predictions"), "batch_size": 4}
+    first_run = ModelEvaluator(EvaluationDataset(image_folder), config).evaluate()
+
+    def fail_tuning(*args, **kwargs):
+        raise AssertionError("batch size tuned while all predictions are stored")
+
+    monkeypatch.setattr(pyro_eval.model_evaluation, "tune_batch_size", fail_tuning)
+    # Predictions stored with another batch size are reused
+    evaluator = ModelEvaluator(EvaluationDataset(image_folder), {**config, "batch_size": None})
+    second_run = evaluator.evaluate()
+
+    assert evaluator.batch_size is None
+    for key in ["precision", "recall", "f1", "fp", "tp", "fn", "predictions"]:
+        assert second_run[key] == first_run[key]
+
+
+def test_pr_curve_matches_metrics_at_conf_threshold(image_folder, stub_engine, tmp_path):
+    # Labels on the top left box of the stub classifier
+    for label_path in (image_folder / "labels").iterdir():
+        label_path.write_text("0 0.2 0.2 0.2 0.2\n")
+    config = {"model_path": stub_engine, "prediction_store": str(tmp_path / "predictions"), "batch_size": 4}
+    # The threshold is the confidence of a true positive, which is not kept at this threshold
+    floor_evaluator = ModelEvaluator(EvaluationDataset(image_folder), {**config, "inference_params": {"conf": 0.01}})
+    floor_evaluator.evaluate()
+    top_left_confidences = sorted(
+        box[4] for image in floor_evaluator.images for box in image.prediction if box[0] == 0.1
+    )
+    conf_threshold = float(top_left_confidences[len(top_left_confidences) // 2])
+
+    config["inference_params"] = {"conf": conf_threshold}
+    metrics = ModelEvaluator(EvaluationDataset(image_folder), config).evaluate()
+    curve_metrics = ModelEvaluator(EvaluationDataset(image_folder), {**config, "pr_curve": True}).evaluate()
+
+    assert metrics["tp"] > 0 and metrics["fp"] > 0 and metrics["fn"] > 0
+    for key in ["precision", "recall", "f1", "fp", "tp", "fn"]:
+        assert curve_metrics[key] == metrics[key]
+    curve = curve_metrics["pr_curve"]
+    # Predictions at the floor confidence, the configured threshold is a point of the curve
+    assert curve["thresholds"][-1] == 0.01
+    point = list(curve["thresholds"]).index(conf_threshold)
+    for key in ["precision", "recall", "f1"]:
+        assert curve[key][point] == metrics[key]
@@ -0,0 +1,92 @@
+import os
+import random
+from datetime import datetime, timedelta
+
+import pandas as pd
+import pytest
+
+from pyro_eval.dataset import EvaluationDataset
+from pyro_eval.utils import has_image_extension, parse_date_from_filename, parse_dates_from_filepaths
+
+
+def reference_sequences(image_list, annotations, timestamps, max_delta=30):
+    """
+    Image by image sequence detection, on images sorted by camera and capture date
+    """
+    data = []
+    current_sequence = None
+    for image_path, boxes, timestamp in zip(image_list, annotations, timestamps):
+        if not has_image_extension(image_path) or timestamp is None:
+            continue
+        image_prefix, _ = parse_date_from_filename(os.path.basename(image_path))
+        if current_sequence is None or not (
+            timestamp - previous_timestamp <= timedelta(minutes=max_delta) and image_prefix == previous_prefix
+        ):
+            current_sequence = os.path.splitext(os.path.basename(image_path))[0]
+            sequence_start = timestamp
+        data.append(
+            {
+                "image": image_path,
+                "sequence_id": current_sequence,
+                "boxes": boxes,
+                "delta": pd.Timedelta(timestamp - sequence_start),
+            }
+        )
+        previous_timestamp, previous_prefix = timestamp, image_prefix
+    return pd.DataFrame(data)
+
+
+def make_image_list(seed=0):
+    """
+    Image paths of several cameras with gaps around max_delta, an image without date and a non image file
+    """
+    rng = random.Random(seed)
+    image_list, annotations = [], []
+    for camera in ["pyronear_sdis-07_brison-200", "pyronear_sdis-07_brison-110", "cam-c_site-3"]:
+        date = datetime(2024, 1, 26, 11, 0, 0)
+        for i in range(40):
+            date += timedelta(minutes=rng.choice([1, 5, 29, 30, 31, 120]), seconds=rng.choice([0, 1]))
+            image_list.append(f"images/{camera}_{date.strftime('%Y-%m-%dt%H-%M-%S')}.jpg")
+            annotations.append([f"0 0.5 0.5 0.{i % 9 + 1} 0.2"] if rng.random() < 0.5 else [])
+    image_list += ["images/cam-c_site-3_nodate.jpg", "images/cam-c_site-3_2024-01-26t11-00-00.txt"]
+    annotations += [[], []]
+    return image_list, annotations
+
+
+@pytest.mark.parametrize("shuffle", [False, True])
+def test_determine_sequences_matches_reference(image_folder, shuffle):
+    dataset = EvaluationDataset(image_folder)
+    image_list, annotations = make_image_list()
+    sorted_list = sorted(zip(image_list, annotations))
+    if shuffle:
+        # Images are sorted by camera, in order of first appearance, then by date
+        rows = list(zip(image_list, annotations))
+        random.Random(1).shuffle(rows)
+        image_list, annotations = zip(*rows)
+        prefixes, timestamps = parse_dates_from_filepaths(image_list)
+        camera_order = {prefix: i for i, prefix in reversed(list(enumerate(prefixes)))}
+        sorted_list = [
+            row
+            for _, _, row in sorted(
+                zip(prefixes, timestamps, rows), key=lambda item: (camera_order[item[0]], item[1])
+            )
+        ]
+    else:
+        image_list, annotations = zip(*sorted_list)
+    _, timestamps = parse_dates_from_filepaths(image_list)
+
+    dataframe = dataset.determine_sequences(list(image_list), list(annotations), timestamps)
+
+    reference_list = [image for image, _ in sorted_list]
+    reference = reference_sequences(
+        reference_list,
+        [boxes for _, boxes in sorted_list],
+        [parse_date_from_filename(os.path.basename(image))[1] for image in reference_list],
+    )
+    # Gaps of exactly max_delta continue a sequence, the cameras have several sequences each
+    assert reference["sequence_id"].nunique() > 6
+    pd.testing.assert_frame_equal(
+        dataframe[["image", "sequence_id", "boxes", "delta"]].reset_index(drop=True),
+        reference,
+        check_dtype=False,
+    )